@@ -0,0 +1,393 @@
+import os
+import random
+import threading
+from contextlib import asynccontextmanager
+from datetime import date, datetime, time, timedelta
+
+from sqlalchemy import select, delete, make_url
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route
+
+import id_generator
+from cache import owner_cache
+from database import (Products, Employees, Outlets, OwnerStats, Replenishments, database_url, replica_urls,
+                      PRIMARY_COOKIE, PRIMARY_STICKY_SECONDS, sales_page_query,
+                      sales_page_lines_query, group_sales_lines, stage_order, bump_owner_stats, compute_owner_stats,
+                      sales_trend_query, fill_sales_trend, ROLLUP_GRANULARITIES, customer_search_queries,
+                      merge_customer_matches)
+from search import latest_product_id, rank_products, read_ranked, STOCK_FILTERS
+
+# the drivers the async engine swaps in for the synchronous ones
+ASYNC_DRIVERS = {'mysql': 'mysql+aiomysql', 'sqlite': 'sqlite+aiosqlite'}
+
+SALES_REPORT_PAGE_SIZE = int(os.getenv('SALES_REPORT_PAGE_SIZE', 25))
+SALES_REPORT_MAX_PAGE_SIZE = int(os.getenv('SALES_REPORT_MAX_PAGE_SIZE', 200))
+SALES_TREND_MAX_POINTS = int(os.getenv('SALES_TREND_MAX_POINTS', 1000))
+CUSTOMER_SEARCH_LIMIT = int(os.getenv('CUSTOMER_SEARCH_LIMIT', 10))
+PRODUCT_SEARCH_PAGE_SIZE = int(os.getenv('PRODUCT_SEARCH_PAGE_SIZE', 20))
+PRODUCT_SEARCH_MAX_PAGE_SIZE = int(os.getenv('PRODUCT_SEARCH_MAX_PAGE_SIZE', 100))
+TREND_PERIODS = {'hour': timedelta(hours=1), 'day': timedelta(days=1), 'month': timedelta(days=31)}
+
+_engine = None
+_replica_engines = None
+_engine_lock = threading.Lock()
+
+
+def async_url(url):
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+
+
+def async_database_url():
+    if os.getenv('DB_ASYNC_STRING'):
+        return os.getenv('DB_ASYNC_STRING')
+    return async_url(database_url())
+
+
+def create_pooled_async_engine(url):
+    return create_async_engine(
+        url,
+        echo=os.getenv('DB_ECHO', 'false').lower() in ('1', 'true', 'yes'),
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=int(os.getenv('DB_POOL_SIZE', 10)),
+        max_overflow=int(os.getenv('DB_MAX_OVERFLOW', 20)),
+        pool_timeout=int(os.getenv('DB_POOL_TIMEOUT', 30)),
+        pool_recycle=int(os.getenv('DB_POOL_RECYCLE', 1800)),
+        pool_pre_ping=os.getenv('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes'))
+
+
+def get_async_engine():
+    global _engine
+
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = create_pooled_async_engine(async_database_url())
+    return _engine
+
+
+def get_async_replica_engines():
+    global _replica_engines
+
+    if _replica_engines is None:
+        with _engine_lock:
+            if _replica_engines is None:
+                _replica_engines = [create_pooled_async_engine(async_url(url)) for url in replica_urls()]
+    return _replica_engines
+
+
+AsyncSession = async_sessionmaker(expire_on_commit=False)
+
+
+def open_session(request=None):
+    # pass the request for a session that only reads: it goes to a replica, unless the client wrote moments ago
+    replicas = get_async_replica_engines() if request is not None and PRIMARY_COOKIE not in request.cookies else []
+    return AsyncSession(bind=random.choice(replicas) if replicas else get_async_engine())
+
+
+def remember_write(response):
+    # the client reads its own writes: the next requests read from the primary for a while
+    if get_async_replica_engines():
+        response.set_cookie(PRIMARY_COOKIE, '1', max_age=PRIMARY_STICKY_SECONDS, httponly=True, samesite='lax')
+    return response
+
+
+def failed(message, status_code=400):
+    return JSONResponse({"status": "failed", "message": message}, status_code=status_code)
+
+
+def data_version(scope):
+    # the async counterpart of database.data_version, on a session of its own opened before the listing's
+    column = getattr(OwnerStats, f'{scope}_version')
+
+    async def version(owner_id):
+        async with open_session() as db:
+            return await db.scalar(select(column).where(OwnerStats.owner_id == owner_id)) or 0
+    return version
+
+
+# the cached fetches return exactly what their counterparts in database.py return, since they share cache entries
+
+@owner_cache.async_cached('products', data_version('products'))
+async def fetch_products(owner_id):
+    async with open_session() as db:
+        rows = await db.execute(select(Products.prod_id, Products.prod_name, Products.prod_price,
+                                       Products.prod_quantity, Products.prod_image, Products.reorder_point,
+                                       Products.reorder_quantity, Products.backordered)
+                                .where(Products.owner_id == owner_id))
+        return [row._asdict() for row in rows]
+
+
+@owner_cache.async_cached('employees', data_version('employees'))
+async def fetch_employees(owner_id):
+    async with open_session() as db:
+        rows = await db.execute(select(Employees.id, Employees.name, Employees.post, Employees.salary)
+                                .where(Employees.owner_id == owner_id))
+        return [row._asdict() for row in rows]
+
+
+@owner_cache.async_cached('store_loc', data_version('outlets'))
+async def fetch_outlets(owner_id):
+    async with open_session() as db:
+        rows = await db.execute(select(Outlets.lat, Outlets.lng).where(Outlets.owner_id == owner_id))
+        return [row._asdict() for row in rows]
+
+
+@owner_cache.async_cached('stock', data_version('products'))
+async def fetch_stock(owner_id):
+    async with open_session() as db:
+        rows = (await db.execute(select(Products.prod_name, Products.prod_quantity)
+                                 .where(Products.owner_id == owner_id))).all()
+        return [row.prod_name for row in rows], [row.prod_quantity for row in rows]
+
+
+async def products(request):
+    return JSONResponse(await fetch_products(request.path_params['owner_id']))
+
+
+async def employees(request):
+    return JSONResponse(await fetch_employees(request.path_params['owner_id']))
+
+
+async def outlets(request):
+    return JSONResponse(await fetch_outlets(request.path_params['owner_id']))
+
+
+async def stock_report(request):
+    names, quantities = await fetch_stock(request.path_params['owner_id'])
+    return JSONResponse({"products": names, "quantities": quantities})
+
+
+async def cards_report(request):
+    owner_id = request.path_params['owner_id']
+
+    async with open_session(request) as db:
+        stats = await db.get(OwnerStats, owner_id)
+
+        if stats is None:
+            # no write yet (or an unknown owner): counted from the raw tables without creating the row
+            computed = await db.run_sync(lambda sync_db: compute_owner_stats(owner_id, db=sync_db))
+            return JSONResponse(computed[owner_id])
+
+    return JSONResponse({
+        'count_products': stats.count_products,
+        'count_customers': stats.count_customers,
+        'total_sales': stats.total_sales,
+    })
+
+
+async def sales_report(request):
+    owner_id = request.path_params['owner_id']
+    args = request.query_params
+
+    try:
+        limit = int(args.get('limit', SALES_REPORT_PAGE_SIZE))
+        before = int(args['cursor']) if args.get('cursor') else None
+        prod_id = int(args['product']) if args.get('product') else None
+        # dates are inclusive on both ends
+        start = datetime.combine(date.fromisoformat(args['start']), time.min) if args.get('start') else None
+        end = (datetime.combine(date.fromisoformat(args['end']) + timedelta(days=1), time.min)
+               if args.get('end') else None)
+    except ValueError:
+        return failed("Invalid filter or cursor")
+
+    if not 1 <= limit <= SALES_REPORT_MAX_PAGE_SIZE:
+        return failed("Invalid page size")
+
+    async with open_session(request) as db:
+        order_ids = (await db.scalars(sales_page_query(owner_id, limit, before, start, end, prod_id))).all()
+        next_cursor = order_ids[limit - 1] if len(order_ids) > limit else None
+        order_ids = order_ids[:limit]
+
+        orders = []
+        if order_ids:
+            lines = await db.execute(sales_page_lines_query(owner_id, order_ids))
+            orders = list(group_sales_lines(lines))
+
+    # order ids are 64-bit and would lose precision as JavaScript numbers
+    for order in orders:
+        order['order_id'] = str(order['order_id'])
+
+    return JSONResponse({
+        "orders": orders,
+        "next_cursor": str(next_cursor) if next_cursor is not None else None
+    })
+
+
+async def sales_trend(request):
+    owner_id = request.path_params['owner_id']
+    args = request.query_params
+    granularity = args.get('granularity', 'day')
+
+    try:
+        prod_id = int(args['product']) if args.get('product') else None
+        # dates are inclusive on both ends; by default the last 30 days
+        end = (datetime.combine(date.fromisoformat(args['end']) + timedelta(days=1), time.min)
+               if args.get('end') else datetime.combine(date.today() + timedelta(days=1), time.min))
+        start = (datetime.combine(date.fromisoformat(args['start']), time.min)
+                 if args.get('start') else end - timedelta(days=30))
+    except ValueError:
+        return failed("Invalid filter")
+
+    if granularity not in ROLLUP_GRANULARITIES:
+        return failed(f"granularity must be one of {list(ROLLUP_GRANULARITIES)}")
+    if not start < end or (end - start) / TREND_PERIODS[granularity] > SALES_TREND_MAX_POINTS:
+        return failed("Invalid range for this granularity")
+
+    async with open_session(request) as db:
+        rows = (await db.execute(sales_trend_query(owner_id, granularity, start, end, prod_id))).all()
+
+    return JSONResponse({"granularity": granularity, "series": fill_sales_trend(rows, granularity, start, end)})
+
+
+async def customer_search(request):
+    queries = customer_search_queries(request.path_params['owner_id'], request.query_params.get('q', ''),
+                                      CUSTOMER_SEARCH_LIMIT)
+
+    async with open_session(request) as db:
+        results = [(await db.execute(query)).all() for query in queries]
+
+    return JSONResponse({"customers": merge_customer_matches(results, CUSTOMER_SEARCH_LIMIT)})
+
+
+async def product_search(request):
+    args = request.query_params
+    stock = args.get('stock', 'any')
+
+    try:
+        limit = int(args.get('limit', PRODUCT_SEARCH_PAGE_SIZE))
+        cursor = int(args.get('cursor') or 0)
+    except ValueError:
+        return failed("Invalid page size or cursor")
+
+    if not 1 <= limit <= PRODUCT_SEARCH_MAX_PAGE_SIZE or cursor < 0:
+        return failed("Invalid page size or cursor")
+    if stock not in STOCK_FILTERS:
+        return failed(f"stock must be one of {list(STOCK_FILTERS)}")
+
+    owner_id = request.path_params['owner_id']
+    async with open_session(request) as db:
+        # the in-process name index is shared with the Flask routes; its (first, possibly slow) build and the
+        # ranking run in a worker thread, only the row reads on the async connection. The highest id comes from
+        # the same database as the rows, so a replica's missing rows are told apart from deleted ones
+        latest = await db.run_sync(latest_product_id, owner_id)
+        index, ranked = await run_in_threadpool(rank_products, owner_id, args.get('q', ''))
+        products, next_cursor, matches = await db.run_sync(read_ranked, owner_id, index, ranked, latest, stock,
+                                                           limit, cursor)
+
+    return JSONResponse({
+        "products": products,
+        "matches": matches,
+        "next_cursor": str(next_cursor) if next_cursor is not None else None
+    })
+
+
+async def place_order(request):
+    owner_id = request.path_params['owner_id']
+
+    try:
+        data = await request.json()
+        order_details = [{'prod_id': int(item['prod_id']), 'prod_quantity': int(item['quantity'])}
+                         for item in data['items']]
+        customer = data['customer']
+        customer_details = {field: customer[field] for field in ('name', 'email', 'address', 'city', 'state', 'zip')}
+    except (ValueError, KeyError, TypeError):
+        return failed("Expected items with prod_id and quantity, and the customer details")
+
+    if not order_details or any(item['prod_quantity'] <= 0 for item in order_details):
+        return failed("An order needs at least one item with a positive quantity")
+
+    async with open_session() as db:
+        try:
+            # the staging logic is the synchronous one from database.py, run on the async connection
+            status = await db.run_sync(stage_order, owner_id, order_details, customer_details)
+            if status == "failed":
+                await db.rollback()
+                return failed("Order references unknown products", status_code=422)
+            await db.commit()
+        except SQLAlchemyError:
+            await db.rollback()
+            print("\033[91mSQLAlchemyError: Could not insert order details\033[0m")
+            return failed("Could not place the order", status_code=500)
+
+    return remember_write(JSONResponse({"status": "success" if status == "done" else status}, status_code=201))
+
+
+async def delete_product(request):
+    owner_id = request.path_params['owner_id']
+
+    async with open_session() as db:
+        try:
+            await db.execute(delete(Replenishments)
+                             .where(Replenishments.prod_id == request.path_params['prod_id'],
+                                    Replenishments.owner_id == owner_id))
+            removed = (await db.execute(delete(Products)
+                                        .where(Products.prod_id == request.path_params['prod_id'],
+                                               Products.owner_id == owner_id))).rowcount
+            await db.run_sync(lambda sync_db: bump_owner_stats(owner_id, products=-removed, touched=('products',),
+                                                                db=sync_db))
+            await db.commit()
+        except SQLAlchemyError:
+            await db.rollback()
+            print("\033[91mCould not delete entry due to Database Error\033[0m")
+            return failed("Could not delete the product", status_code=500)
+
+    if not removed:
+        return failed("No such product", status_code=404)
+
+    return remember_write(JSONResponse({"status": "success"}))
+
+
+async def delete_employee(request):
+    owner_id = request.path_params['owner_id']
+
+    async with open_session() as db:
+        try:
+            removed = (await db.execute(delete(Employees)
+                                        .where(Employees.id == request.path_params['emp_id'],
+                                               Employees.owner_id == owner_id))).rowcount
+            await db.run_sync(lambda sync_db: bump_owner_stats(owner_id, touched=('employees',), db=sync_db))
+            await db.commit()
+        except SQLAlchemyError:
+            await db.rollback()
+            print("\033[91mCould not delete entry due to Database Error\033[0m")
+            return failed("Could not delete the employee", status_code=500)
+
+    if not removed:
+        return failed("No such employee", status_code=404)
+
+    return remember_write(JSONResponse({"status": "success"}))
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # a process slot of its own, so orders placed here and through the development server or a CLI command on
+    # the same host never share a worker id; every further API process needs its own ORDER_ID_PROCESS
+    id_generator.configure(id_generator.process_worker_id(default=1))
+    yield
+    for engine in [_engine] + (_replica_engines or []):
+        if engine is not None:
+            await engine.dispose()
+
+
+owner_routes = [
+    Route("/products", products),
+    Route("/products/search", product_search),
+    Route("/products/{prod_id:int}", delete_product, methods=['DELETE']),
+    Route("/orders", place_order, methods=['POST']),
+    Route("/customers/search", customer_search),
+    Route("/employees", employees),
+    Route("/employees/{emp_id:int}", delete_employee, methods=['DELETE']),
+    Route("/outlets", outlets),
+    Route("/reports/sales", sales_report),
+    Route("/reports/trend", sales_trend),
+    Route("/reports/stock", stock_report),
+    Route("/reports/cards", cards_report),
+]
+
+app = Starlette(routes=[Mount("/api/v1/owners/{owner_id:int}", routes=owner_routes)], lifespan=lifespan)
@@ -0,0 +1,163 @@
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import posixpath
+import re
+import shutil
+
+from flask import request, send_from_directory
+
+try:
+    import brotli
+except ImportError:  # optional: without it only the gzip copies are built
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = 'manifest.json'
+HASH_LENGTH = 12
+
+# a year, the longest lifetime browsers honour; a changed file gets a new name, so it never has to be revalidated
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+
+# formats that are not compressed already (woff2, png and jpg are) and are worth a precompressed copy
+COMPRESSIBLE = ('.css', '.js', '.svg', '.ico', '.ttf', '.otf', '.eot', '.json', '.map', '.txt')
+MIN_COMPRESS_SIZE = 1024
+
+# content codings in order of preference, with the suffix of their precompressed copy
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+?)\1\s*\)""")
+
+
+def fingerprinted_name(name, content):
+    digest = hashlib.sha256(content).hexdigest()[:HASH_LENGTH]
+    root, extension = posixpath.splitext(name)
+    return f"{root}.{digest}{extension}"
+
+
+def compressed_copies(content):
+    copies = {'.gz': gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        copies['.br'] = brotli.compress(content, quality=11)
+    # a copy that saves next to nothing only costs disk space and a negotiation
+    return {suffix: data for suffix, data in copies.items() if len(data) < len(content) * 0.9}
+
+
+def build(source, target):
+    # copies every file under `source` to `target` as name.<hash>.ext plus .gz/.br copies, and writes the
+    # logical -> fingerprinted name manifest. Returns the manifest
+    if os.path.isdir(target):
+        if os.listdir(target) and not os.path.exists(os.path.join(target, MANIFEST_NAME)):
+            raise ValueError(f"{target} is not empty and was not built by build-assets, refusing to replace it")
+        shutil.rmtree(target)
+
+    names = set()
+    for directory, _, files in os.walk(source):
+        for file_name in files:
+            names.add(posixpath.join(*os.path.relpath(os.path.join(directory, file_name), source).split(os.sep)))
+
+    files, encodings = {}, {}
+
+    def fingerprint(name, seen=()):
+        # stylesheets are rewritten to point at the fingerprinted fonts and images before they are hashed
+        # themselves, so a changed font also gives the stylesheet that loads it a new name
+        if name in files:
+            return files[name]
+
+        with open(os.path.join(source, *name.split('/')), 'rb') as asset:
+            content = asset.read()
+
+        if name.endswith('.css'):
+            def rewrite(match):
+                # only relative references to files we have; data:, absolute and #fragment urls stay as they are
+                quote, reference = match.groups()
+                path, tail = re.match(r'([^?#]*)(.*)', reference).groups()
+                if not path or re.match(r'^(?:[a-z]+:|/)', path):
+                    return match.group(0)
+                resolved = posixpath.normpath(posixpath.join(posixpath.dirname(name), path))
+                if resolved not in names or resolved in seen:
+                    return match.group(0)
+                hashed = posixpath.relpath(fingerprint(resolved, seen + (name,)), posixpath.dirname(name))
+                return f"url({quote}{hashed}{tail}{quote})"
+
+            content = CSS_URL.sub(rewrite, content.decode('utf-8')).encode('utf-8')
+
+        hashed = fingerprinted_name(name, content)
+        output = os.path.join(target, *hashed.split('/'))
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with open(output, 'wb') as asset:
+            asset.write(content)
+
+        available = []
+        if name.endswith(COMPRESSIBLE) and len(content) >= MIN_COMPRESS_SIZE:
+            copies = compressed_copies(content)
+            for encoding, suffix in ENCODINGS:
+                if suffix in copies:
+                    with open(output + suffix, 'wb') as copy:
+                        copy.write(copies[suffix])
+                    available.append(encoding)
+
+        files[name] = hashed
+        if available:
+            encodings[hashed] = available
+        return hashed
+
+    for name in sorted(names):
+        fingerprint(name)
+
+    manifest = {'files': files, 'encodings': encodings}
+    with open(os.path.join(target, MANIFEST_NAME), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    return manifest
+
+
+def load_manifest(target):
+    try:
+        with open(os.path.join(target, MANIFEST_NAME)) as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return None
+
+
+def init_app(app):
+    # with a built manifest, url_for('static', ...) emits the fingerprinted names and those are served with
+    # immutable caching and their precompressed copies; without one the static files are served as before
+    target = app.config['ASSET_BUILD_DIR']
+    manifest = load_manifest(target)
+    if manifest is None:
+        logger.info("no asset manifest in %s, serving static files unfingerprinted", target)
+        return
+
+    files = manifest['files']
+    encodings = manifest['encodings']
+    fingerprinted = set(files.values())
+    plain_static = app.view_functions['static']
+
+    @app.url_defaults
+    def fingerprinted_url(endpoint, values):
+        if endpoint == 'static' and 'filename' in values:
+            values['filename'] = files.get(values['filename'], values['filename'])
+
+    def static(filename):
+        if filename not in fingerprinted:
+            # unknown to the manifest (added after the build, or an old name): the regular handler
+            return plain_static(filename=filename)
+
+        available = encodings.get(filename, ())
+        encoding, suffix = next(((encoding, suffix) for encoding, suffix in ENCODINGS
+                                 if encoding in available and request.accept_encodings[encoding]), (None, ''))
+        response = send_from_directory(target, filename + suffix, max_age=ASSET_MAX_AGE,
+                                       mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        if available:
+            response.vary.add('Accept-Encoding')
+        if encoding:
+            response.content_encoding = encoding
+        return response
+
+    app.view_functions['static'] = static
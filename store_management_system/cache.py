@@ -0,0 +1,198 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+MISSING = object()
+
+
+class CacheBackend:
+    # what the owner cache needs from a store; values are JSON-serialisable so a shared store can hold them
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        raise NotImplementedError
+
+    def delete(self, *keys):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class NullCache(CacheBackend):
+    def get(self, key):
+        return MISSING
+
+    def set(self, key, value, ttl):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+    def clear(self):
+        pass
+
+
+class LRUCache(CacheBackend):
+    # in-process, bounded by entry count and expiring entries after their ttl
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return MISSING
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCache(CacheBackend):
+    # shared between workers; works with redis-py or any local stand-in offering get/set(ex=)/delete/scan_iter
+
+    def __init__(self, client, prefix='sms:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return MISSING if raw is None else json.loads(raw)
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, json.dumps(value), ex=int(ttl))
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        for key in self.client.scan_iter(match=self.prefix + '*'):
+            self.client.delete(key)
+
+
+class OwnerCache:
+    # read-through cache for per-owner listings. Entries are stored under the owner's data version of the
+    # listing, which every write bumps in its own transaction: an entry is never read again once a write in any
+    # process has committed, whichever backend holds it, and old entries just age out
+
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(namespace, owner_id):
+        return f"owner:{owner_id}:{namespace}"
+
+    def _count(self, namespace, outcome):
+        with self._lock:
+            counters = self._counters.setdefault(namespace, {'hits': 0, 'misses': 0})
+            counters[outcome] += 1
+
+    def _lookup(self, namespace, key):
+        value = self.backend.get(key)
+        self._count(namespace, 'misses' if value is MISSING else 'hits')
+        return value
+
+    def _store(self, key, value):
+        # the retrieve functions signal database errors with None/False, which must not be cached
+        if value is not None and value is not False:
+            self.backend.set(key, value, self.ttl)
+
+    def cached(self, namespace, version):
+        # `version(owner_id)` reads the data version the listing depends on, in the same session as the listing;
+        # without one (None) the listing is read uncached
+        def decorator(fn):
+            @wraps(fn)
+            def wrapper(owner_id):
+                current = version(owner_id)
+                if current is None:
+                    return fn(owner_id)
+
+                key = f"{self.key(namespace, owner_id)}:{current}"
+                value = self._lookup(namespace, key)
+
+                if value is MISSING:
+                    value = fn(owner_id)
+                    self._store(key, value)
+                return value
+            return wrapper
+        return decorator
+
+    def async_cached(self, namespace, version):
+        # same keys and values as cached(), so the async API and the Flask routes share entries
+        def decorator(fn):
+            @wraps(fn)
+            async def wrapper(owner_id):
+                key = f"{self.key(namespace, owner_id)}:{await version(owner_id)}"
+                value = self._lookup(namespace, key)
+
+                if value is MISSING:
+                    value = await fn(owner_id)
+                    self._store(key, value)
+                return value
+            return wrapper
+        return decorator
+
+    def versioned(self, owner_id, name, version, build):
+        # a value stored under the data version it was built from, for callers that already know the version
+        key = f"{self.key(name, owner_id)}:{version}"
+        value = self._lookup('versioned', key)
+
+        if value is MISSING:
+            value = build()
+            self._store(key, value)
+        return value
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        with self._lock:
+            return {namespace: dict(counters) for namespace, counters in self._counters.items()}
+
+
+def make_backend():
+    backend = os.getenv('CACHE_BACKEND', 'lru').lower()
+
+    if backend == 'none':
+        return NullCache()
+    if backend == 'redis':
+        import redis  # optional dependency, only needed for the shared backend
+        return RedisCache(redis.Redis.from_url(os.getenv('CACHE_REDIS_URL', 'redis://localhost:6379/0')))
+    return LRUCache(max_entries=int(os.getenv('CACHE_MAX_ENTRIES', 4096)))
+
+
+owner_cache = OwnerCache(make_backend(), ttl=int(os.getenv('CACHE_TTL', 300)))
@@ -1,18 +1,35 @@
 import os
-from datetime import datetime
 import random
-
-import bcrypt
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from itertools import groupby
 
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, Column, String, Integer, select, ForeignKey, Float, and_
-from sqlalchemy.orm import sessionmaker, declarative_base, relationship
+from flask import has_app_context
+from flask.globals import app_ctx
+from sqlalchemy import (create_engine, Column, String, Integer, BigInteger, select, insert, update, delete, bindparam,
+                        ForeignKey, Float, DateTime, Index, and_, case, func)
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session as OrmSession, sessionmaker, scoped_session, declarative_base, relationship
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 
+from cache import owner_cache
+from id_generator import next_order_id
+from images import schedule_variants
+from passwords import PasswordPoolBusy, hash_password, check_password, needs_rehash
+
 
-load_dotenv()
 Base = declarative_base()
 
+DEFAULT_REORDER_POINT = int(os.getenv('DEFAULT_REORDER_POINT', 10))
+DEFAULT_REORDER_QUANTITY = int(os.getenv('DEFAULT_REORDER_QUANTITY', 100))
+
+# what each data version covers: products and stock; orders, customers and the sales cards; employees; outlets
+VERSION_SCOPES = ('products', 'sales', 'employees', 'outlets')
+
 
 class Owners(Base):
     __tablename__ = "owners"
@@ -37,6 +54,9 @@ class Owners(Base):
 
 class Outlets(Base):
     __tablename__ = "outlets"
+    __table_args__ = (
+        Index('ix_outlets_owner_id', 'owner_id', 'id'),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     lat = Column(Float, nullable=False)
@@ -50,6 +70,9 @@ class Outlets(Base):
 
 class Employees(Base):
     __tablename__ = "employee"
+    __table_args__ = (
+        Index('ix_employee_owner_id', 'owner_id', 'id'),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String(100), nullable=False)
@@ -64,6 +87,9 @@ class Employees(Base):
 
 class Products(Base):
     __tablename__ = "products"
+    __table_args__ = (
+        Index('ix_products_owner_prod', 'owner_id', 'prod_id'),
+    )
 
     owner_id = Column(Integer, ForeignKey('owners.id'))
     prod_id = Column(Integer, primary_key=True, autoincrement=True)
@@ -71,6 +97,13 @@ class Products(Base):
     prod_price = Column(Integer, nullable=False)
     prod_quantity = Column(Integer, nullable=False)
     prod_image = Column(String(500), nullable=False)
+    # a replenishment is suggested once on hand minus backordered units falls to the reorder point
+    reorder_point = Column(Integer, nullable=False, default=DEFAULT_REORDER_POINT,
+                           server_default=str(DEFAULT_REORDER_POINT))
+    reorder_quantity = Column(Integer, nullable=False, default=DEFAULT_REORDER_QUANTITY,
+                              server_default=str(DEFAULT_REORDER_QUANTITY))
+    # units sold while out of stock, delivered from the next replenishment
+    backordered = Column(Integer, nullable=False, default=0, server_default='0')
     orders = relationship('Orders', back_populates='product')
 
     def __repr__(self):
@@ -79,16 +112,29 @@ class Products(Base):
 
 class Orders(Base):
     __tablename__ = "orders"
+    __table_args__ = (
+        Index('ix_orders_owner_order', 'owner_id', 'order_id'),
+        Index('ix_orders_owner_prod', 'owner_id', 'prod_id'),
+        Index('ix_orders_owner_ordered_at', 'owner_id', 'ordered_at'),
+        Index('ix_orders_owner_customer', 'owner_id', 'customer_id'),
+        Index('ix_orders_prod_backordered', 'prod_id', 'backordered_quantity'),
+    )
 
     order_val = Column(Integer, primary_key=True, autoincrement=True)
-    order_id = Column(Integer, nullable=False)
+    order_id = Column(BigInteger, nullable=False)
     prod_id = Column(Integer, ForeignKey('products.prod_id'), nullable=False)
     owner_id = Column(Integer, ForeignKey('owners.id'), nullable=False)
     sold_prod_quantity = Column(Integer, nullable=False)
+    ordered_at = Column(DateTime, default=datetime.now)
+    # orders placed before customers were deduplicated are not linked to one
+    customer_id = Column(Integer, ForeignKey('customers.customer_id'), nullable=True)
+    # part of sold_prod_quantity still waiting for stock
+    backordered_quantity = Column(Integer, nullable=False, default=0, server_default='0')
 
     # Relationships
     product = relationship('Products', back_populates='orders')
     owner = relationship('Owners', back_populates='orders')
+    customer = relationship('Customers', back_populates='orders')
 
     def __repr__(self):
         return (f"Orders(order_id={self.order_id}, "
@@ -99,6 +145,12 @@ class Orders(Base):
 
 class Customers(Base):
     __tablename__ = "customers"
+    __table_args__ = (
+        Index('ix_customers_owner_id', 'owner_id', 'customer_id'),
+        # one customer per normalized email and owner; both keys also serve the prefix search of the order form
+        Index('uq_customers_owner_email', 'owner_id', 'email_key', unique=True),
+        Index('ix_customers_owner_name', 'owner_id', 'name_key'),
+    )
 
     owner_id = Column(Integer, ForeignKey('owners.id'))
     customer_id = Column(Integer, primary_key=True, autoincrement=True)
@@ -108,7 +160,12 @@ class Customers(Base):
     customer_city = Column(String(100), nullable=False)
     customer_state = Column(String(100), nullable=False)
     customer_zip = Column(Integer, nullable=False)
+    # NULL for customers without an email, which are never merged
+    email_key = Column(String(100), nullable=True)
+    name_key = Column(String(100), nullable=False, server_default='')
+    order_count = Column(Integer, nullable=False, default=0, server_default='0')
     owner = relationship('Owners', back_populates='customers')
+    orders = relationship('Orders', back_populates='customer')
 
     def __repr__(self):
         return (f"Customers(customer_id={self.customer_id}, "
@@ -119,87 +176,547 @@ class Customers(Base):
                 f"customer_state={self.customer_state}, "
                 f"customer_zip={self.customer_zip})")
 
-db_user = os.getenv('DB_USER')
-db_password = os.getenv('DB_PASSWORD')
-db_host = os.getenv('DB_HOST', 'localhost')
-db_name = os.getenv('DB_NAME', 'default_db_name')
 
-db_string = f"mysql+pymysql://{db_user}:{db_password}@{db_host}/{db_name}"
+class OwnerStats(Base):
+    __tablename__ = "owner_stats"
 
-engine = create_engine(db_string, echo=True)
+    # dashboard KPIs, kept up to date by the write paths so the cards never rescan the raw tables
+    owner_id = Column(Integer, ForeignKey('owners.id'), primary_key=True)
+    count_products = Column(Integer, nullable=False, default=0)
+    count_customers = Column(Integer, nullable=False, default=0)
+    total_sales = Column(BigInteger, nullable=False, default=0)
+    # data versions of the owner's pages, bumped with the writes that change them (see VERSION_SCOPES);
+    # the conditional GETs and the cached page fragments are keyed on them
+    products_version = Column(Integer, nullable=False, default=0, server_default='0')
+    sales_version = Column(Integer, nullable=False, default=0, server_default='0')
+    employees_version = Column(Integer, nullable=False, default=0, server_default='0')
+    outlets_version = Column(Integer, nullable=False, default=0, server_default='0')
+    modified_at = Column(DateTime, nullable=True)
 
-Session = sessionmaker(bind=engine)
-session = Session()  # we can do all sort of things with this now
-Base.metadata.create_all(bind=engine)  # takes all the classes and creates their database
+    def __repr__(self):
+        return (f"OwnerStats(owner_id={self.owner_id}, "
+                f"count_products={self.count_products}, "
+                f"count_customers={self.count_customers}, "
+                f"total_sales={self.total_sales})")
 
 
-def get_sales_report(owner_id):
-    result = []
+class Replenishments(Base):
+    __tablename__ = "replenishments"
+    __table_args__ = (
+        Index('ix_replenishments_owner_status', 'owner_id', 'status', 'id'),
+        # set only while the suggestion is open, so a product never has two open suggestions
+        Index('uq_replenishments_open', 'open_prod_id', unique=True),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    owner_id = Column(Integer, ForeignKey('owners.id'), nullable=False)
+    prod_id = Column(Integer, ForeignKey('products.prod_id'), nullable=False)
+    open_prod_id = Column(Integer, nullable=True)
+    quantity = Column(Integer, nullable=False)
+    # stock levels when the suggestion was made
+    on_hand = Column(Integer, nullable=False)
+    backordered = Column(Integer, nullable=False)
+    status = Column(String(10), nullable=False, default='open')
+    received_quantity = Column(Integer, nullable=True)
+    created_at = Column(DateTime, nullable=False, default=datetime.now)
+    resolved_at = Column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return (f"Replenishments(id={self.id}, "
+                f"prod_id={self.prod_id}, "
+                f"quantity={self.quantity}, "
+                f"status={self.status})")
+
+
+class SalesRollup(Base):
+    __tablename__ = "sales_rollups"
+
+    # revenue and units sold per time bucket, for the owner as a whole (prod_id 0) and for each product;
+    # the primary key order serves "one series of one owner over a range" as a single index range scan
+    owner_id = Column(Integer, ForeignKey('owners.id'), primary_key=True)
+    granularity = Column(String(5), primary_key=True)
+    prod_id = Column(Integer, primary_key=True, autoincrement=False)
+    bucket_start = Column(DateTime, primary_key=True)
+    revenue = Column(BigInteger, nullable=False, default=0)
+    units = Column(BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        return (f"SalesRollup(owner_id={self.owner_id}, "
+                f"granularity={self.granularity}, "
+                f"prod_id={self.prod_id}, "
+                f"bucket_start={self.bucket_start}, "
+                f"revenue={self.revenue}, "
+                f"units={self.units})")
+
+
+ROLLUP_GRANULARITIES = ('hour', 'day', 'month')
+
+
+def bucket_start(moment, granularity):
+    moment = moment.replace(minute=0, second=0, microsecond=0)
+    if granularity in ('day', 'month'):
+        moment = moment.replace(hour=0)
+    if granularity == 'month':
+        moment = moment.replace(day=1)
+    return moment
+
+
+def next_bucket(moment, granularity):
+    if granularity == 'hour':
+        return moment + timedelta(hours=1)
+    if granularity == 'day':
+        return moment + timedelta(days=1)
+    return moment.replace(year=moment.year + moment.month // 12, month=moment.month % 12 + 1)
+
+
+_engine = None
+_replica_engines = None
+_engine_lock = threading.Lock()
+
+
+def database_url():
+    load_dotenv()
+
+    db_user = os.getenv('DB_USER')
+    db_password = os.getenv('DB_PASSWORD')
+    db_host = os.getenv('DB_HOST', 'localhost')
+    db_name = os.getenv('DB_NAME', 'default_db_name')
+
+    return os.getenv('DB_STRING', f"mysql+pymysql://{db_user}:{db_password}@{db_host}/{db_name}")
+
 
-    query_orders = session.query(Orders.order_id).filter(Orders.owner_id == owner_id).distinct().all()
+# a client that wrote gets this cookie and reads from the primary until it expires, which should outlast the
+# replication lag
+PRIMARY_COOKIE = 'db_primary'
+PRIMARY_STICKY_SECONDS = int(os.getenv('DB_PRIMARY_STICKY_SECONDS', 5))
 
-    for index, order in enumerate(query_orders, start=1):
 
-        query_products = session.query(Orders.prod_id).filter(Orders.order_id == order.order_id).all()
-        product_list = [prod.prod_id for prod in query_products]
+def replica_urls():
+    # read replicas of the primary, comma separated; without any every query goes to the primary
+    load_dotenv()
+    return [url.strip() for url in os.getenv('DB_REPLICA_URLS', '').split(',') if url.strip()]
 
+
+def create_pooled_engine(url):
+    return create_engine(
+        url,
+        echo=os.getenv('DB_ECHO', 'false').lower() in ('1', 'true', 'yes'),
+        poolclass=QueuePool,
+        pool_size=int(os.getenv('DB_POOL_SIZE', 10)),
+        max_overflow=int(os.getenv('DB_MAX_OVERFLOW', 20)),
+        pool_timeout=int(os.getenv('DB_POOL_TIMEOUT', 30)),
+        pool_recycle=int(os.getenv('DB_POOL_RECYCLE', 1800)),
+        pool_pre_ping=os.getenv('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes'))
+
+
+def get_engine():
+    # created on first use rather than at import, so importing the app never touches the database
+    global _engine
+
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = create_pooled_engine(database_url())
+    return _engine
+
+
+def get_replica_engines():
+    global _replica_engines
+
+    if _replica_engines is None:
+        with _engine_lock:
+            if _replica_engines is None:
+                _replica_engines = [create_pooled_engine(url) for url in replica_urls()]
+    return _replica_engines
+
+
+def dispose_engine():
+    # after fork(): forget the parent's connections without closing them under its feet
+    for engine in [_engine] + (_replica_engines or []):
+        if engine is not None:
+            engine.dispose(close=False)
+
+
+def init_db():
+    Base.metadata.create_all(bind=get_engine())  # takes all the classes and creates their tables
+
+
+def session_scope():
+    # one session per Flask app context (i.e. per request), falling back to one per thread outside of Flask
+    if has_app_context():
+        return id(app_ctx._get_current_object())
+    return threading.get_ident()
+
+
+class RoutingSession(OrmSession):
+    # plain SELECTs inside replica_reads() go to a replica, everything else to the primary. Once the session has
+    # written, or is marked with info['primary'] (a client that wrote moments ago), it reads from the primary
+    # too, so nobody misses their own writes because a replica lags behind
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or getattr(clause, 'is_dml', False):
+            self.info['wrote'] = self.info['primary'] = True
+        elif (self.info.get('replica_reads') and not self.info.get('primary') and getattr(clause, 'is_select', False)
+              and clause._for_update_arg is None):
+            replicas = get_replica_engines()
+            if replicas:
+                # one replica per session, so the reads of a request never go back in time
+                if 'replica' not in self.info:
+                    self.info['replica'] = random.randrange(len(replicas))
+                return replicas[self.info['replica']]
+        return super().get_bind(mapper=mapper, clause=clause, **kwargs)
+
+
+Session = sessionmaker(class_=RoutingSession)
+# proxies to the session of the current request; the engine is bound when that session is first created
+session = scoped_session(lambda: Session(bind=get_engine()), scopefunc=session_scope)
+
+
+@contextmanager
+def replica_reads(db=session):
+    # the reads in this block (or decorated function) may be served by a replica, i.e. be slightly behind the
+    # primary. Only for reads that nothing is written back from
+    depth = db.info.get('replica_reads', 0)
+    db.info['replica_reads'] = depth + 1
+    try:
+        yield
+    finally:
+        db.info['replica_reads'] = depth
+
+
+def sales_lines_query(owner_id):
+    # one row per order line, already priced, ordered so lines of the same order are adjacent
+    return (select(Orders.order_id,
+                   Orders.prod_id,
+                   Orders.sold_prod_quantity,
+                   Products.prod_price)
+            .join(Products, Products.prod_id == Orders.prod_id)
+            .where(Orders.owner_id == owner_id)
+            .order_by(Orders.order_id, Orders.order_val))
+
+
+def group_sales_lines(lines, start=1):
+    for index, (order_id, order_lines) in enumerate(groupby(lines, key=lambda line: line.order_id), start=start):
+        product_list = []
         total_sales = 0
 
-        for prod in product_list:
-            query_price = session.query(Products.prod_price).filter(Products.prod_id == prod).one()
-            total_sales += query_price[0]
+        for line in order_lines:
+            product_list.append(line.prod_id)
+            total_sales += line.prod_price * int(line.sold_prod_quantity)
 
-        result.append({
+        yield {
             'order_number': index,
-            'order_id': order.order_id,
+            'order_id': order_id,
             'product_list': product_list,
             'total_sales': total_sales,
-        })
+        }
+
+
+def iter_sales_report(owner_id, batch_size=1000):
+    lines = session.execute(sales_lines_query(owner_id).execution_options(yield_per=batch_size))
+    yield from group_sales_lines(lines)
+
+
+@replica_reads()
+def get_sales_report(owner_id):
+    return list(iter_sales_report(owner_id))
+
 
-    return result
+def sales_page_query(owner_id, limit, before=None, start=None, end=None, prod_id=None):
+    # order ids of one page, newest first; fetches one extra row to tell whether another page follows
+    page_query = select(Orders.order_id).where(Orders.owner_id == owner_id)
+
+    if before is not None:
+        page_query = page_query.where(Orders.order_id < before)
+    if start is not None:
+        page_query = page_query.where(Orders.ordered_at >= start)
+    if end is not None:
+        page_query = page_query.where(Orders.ordered_at < end)
+    if prod_id is not None:
+        page_query = page_query.where(Orders.prod_id == prod_id)
+
+    return page_query.distinct().order_by(Orders.order_id.desc()).limit(limit + 1)
+
+
+def sales_page_lines_query(owner_id, order_ids):
+    return (sales_lines_query(owner_id)
+            .where(Orders.order_id.in_(order_ids))
+            .order_by(None)
+            .order_by(Orders.order_id.desc(), Orders.order_val))
+
+
+@replica_reads()
+def get_sales_report_page(owner_id, limit, before=None, start=None, end=None, prod_id=None):
+    # keyset pagination over order_id: returns the page and the cursor for the next one
+    order_ids = session.scalars(sales_page_query(owner_id, limit, before, start, end, prod_id)).all()
+
+    next_cursor = order_ids[limit - 1] if len(order_ids) > limit else None
+    order_ids = order_ids[:limit]
+
+    if not order_ids:
+        return [], None
+
+    lines = session.execute(sales_page_lines_query(owner_id, order_ids))
+    return list(group_sales_lines(lines)), next_cursor
+
+
+CUSTOMER_DETAILS = ('customer_name', 'customer_email', 'customer_address', 'customer_city', 'customer_state',
+                    'customer_zip')
+
+
+def normalize_email(email):
+    return str(email).strip().lower()
+
+
+def normalize_name(name):
+    return " ".join(str(name).split()).lower()
+
+
+def upsert_customers(db, owner_id, rows):
+    # rows hold the CUSTOMER_DETAILS columns (and optionally order_count); one customer per owner and normalized
+    # email, the latest details win and order counts add up. Returns {email_key: customer_id} and how many are new
+    owner_id = int(owner_id)
+    merged, anonymous = {}, []
+
+    for row in rows:
+        email_key = normalize_email(row['customer_email'])
+        customer = {column: row[column] for column in CUSTOMER_DETAILS}
+        customer['customer_email'] = str(row['customer_email']).strip()
+        customer.update(owner_id=owner_id, email_key=email_key or None, name_key=normalize_name(row['customer_name']),
+                        order_count=int(row.get('order_count', 0)))
+        if not email_key:
+            # without an email there is nothing to match on, so every such row stays its own customer
+            anonymous.append(customer)
+        elif email_key in merged:
+            customer['order_count'] += merged[email_key]['order_count']
+            merged[email_key] = customer
+        else:
+            merged[email_key] = customer
+
+    if anonymous:
+        db.execute(insert(Customers), anonymous)
+    if not merged:
+        return {}, len(anonymous)
+
+    ids = dict(db.execute(select(Customers.email_key, Customers.customer_id)
+                          .where(Customers.owner_id == owner_id, Customers.email_key.in_(merged))).all())
+
+    table = Customers.__table__
+    updated = CUSTOMER_DETAILS + ('name_key',)
+    if db.get_bind().dialect.name == 'mysql':
+        statement = mysql_insert(table)
+        statement = statement.on_duplicate_key_update(
+            order_count=table.c.order_count + statement.inserted.order_count,
+            **{column: statement.inserted[column] for column in updated})
+    else:
+        statement = sqlite_insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.owner_id, table.c.email_key],
+            set_={'order_count': table.c.order_count + statement.excluded.order_count,
+                  **{column: statement.excluded[column] for column in updated}})
+
+    # in key order, like the rollups, so concurrent upserts lock rows in the same order
+    db.execute(statement, [merged[email_key] for email_key in sorted(merged)])
+
+    new_keys = [email_key for email_key in merged if email_key not in ids]
+    if new_keys:
+        ids.update(db.execute(select(Customers.email_key, Customers.customer_id)
+                              .where(Customers.owner_id == owner_id, Customers.email_key.in_(new_keys))).all())
+
+    # a customer created by a concurrent transaction between the lookup and the upsert is counted as new by both;
+    # rebuild-stats corrects the card if that ever happens
+    return ids, len(new_keys) + len(anonymous)
+
+
+def upsert_customer(db, owner_id, customer_details):
+    # the customer of one order; returns its id and whether it is a new customer
+    row = {column: customer_details[column.removeprefix('customer_')] for column in CUSTOMER_DETAILS}
+    email_key = normalize_email(row['customer_email'])
+
+    if not email_key:
+        customer = db.execute(insert(Customers).values(owner_id=int(owner_id), email_key=None, order_count=1,
+                                                       name_key=normalize_name(row['customer_name']), **row))
+        return customer.inserted_primary_key[0], True
+
+    ids, created = upsert_customers(db, owner_id, [{**row, 'order_count': 1}])
+    return ids[email_key], created == 1
+
+
+def dedupe_customers(db, batch_size=1000):
+    # one-off merge of the rows older versions inserted for every order: the normalized keys are filled in, then
+    # each group of rows sharing an owner and email collapses into its newest row, which takes over their orders.
+    # Returns the number of rows removed per owner
+    table = Customers.__table__
+    orders = Orders.__table__
+
+    last_id = 0
+    while True:
+        rows = db.execute(select(table.c.customer_id, table.c.customer_email, table.c.customer_name)
+                          .where(table.c.customer_id > last_id, table.c.name_key == '')
+                          .order_by(table.c.customer_id)
+                          .limit(batch_size)).all()
+        if not rows:
+            break
+
+        db.execute(update(table)
+                   .where(table.c.customer_id == bindparam('b_customer_id'))
+                   .values(email_key=bindparam('b_email_key'), name_key=bindparam('b_name_key')),
+                   [{'b_customer_id': row.customer_id,
+                     'b_email_key': normalize_email(row.customer_email) or None,
+                     'b_name_key': normalize_name(row.customer_name)} for row in rows])
+        last_id = rows[-1].customer_id
+
+    groups = db.execute(select(table.c.owner_id, table.c.email_key, func.max(table.c.customer_id),
+                               func.sum(table.c.order_count), func.count())
+                        .where(table.c.email_key.is_not(None))
+                        .group_by(table.c.owner_id, table.c.email_key)
+                        .having(func.count() > 1)).all()
+
+    duplicates = (select(table.c.customer_id)
+                  .where(table.c.owner_id == bindparam('b_owner_id'), table.c.email_key == bindparam('b_email_key'),
+                         table.c.customer_id != bindparam('b_keep')))
+    removed = {}
+
+    for position in range(0, len(groups), batch_size):
+        batch = [{'b_owner_id': owner_id, 'b_email_key': email_key, 'b_keep': keep, 'b_order_count': order_count or 0}
+                 for owner_id, email_key, keep, order_count, _ in groups[position:position + batch_size]]
+
+        db.execute(update(orders)
+                   .where(orders.c.customer_id.in_(duplicates.scalar_subquery()))
+                   .values(customer_id=bindparam('b_keep')), batch)
+        db.execute(update(table)
+                   .where(table.c.customer_id == bindparam('b_keep'))
+                   .values(order_count=bindparam('b_order_count')), batch)
+        db.execute(table.delete()
+                   .where(table.c.owner_id == bindparam('b_owner_id'), table.c.email_key == bindparam('b_email_key'),
+                          table.c.customer_id != bindparam('b_keep')), batch)
+
+    for owner_id, _, _, _, count in groups:
+        removed[owner_id] = removed.get(owner_id, 0) + count - 1
+    return removed
+
+
+def prefix_range(column, prefix):
+    # a range on the lowercase key rather than LIKE, which not every backend and collation serves from the index
+    return and_(column >= prefix, column < prefix[:-1] + chr(ord(prefix[-1]) + 1))
+
+
+def customer_search_queries(owner_id, prefix, limit):
+    columns = (Customers.customer_id, Customers.customer_name, Customers.customer_email, Customers.customer_address,
+               Customers.customer_city, Customers.customer_state, Customers.customer_zip, Customers.order_count)
+    email_prefix, name_prefix = normalize_email(prefix), normalize_name(prefix)
+    if not email_prefix or not name_prefix:
+        return []
+
+    return [select(*columns)
+            .where(Customers.owner_id == int(owner_id), prefix_range(Customers.email_key, email_prefix))
+            .order_by(Customers.email_key)
+            .limit(limit),
+            select(*columns)
+            .where(Customers.owner_id == int(owner_id), prefix_range(Customers.name_key, name_prefix))
+            .order_by(Customers.name_key, Customers.customer_id)
+            .limit(limit)]
+
+
+def merge_customer_matches(results, limit):
+    # email matches first, then name matches, each customer once
+    found = {}
+    for rows in results:
+        for row in rows:
+            found.setdefault(row.customer_id, row._asdict())
+    return list(found.values())[:limit]
+
+
+@replica_reads()
+def search_customers(owner_id, prefix, limit=10):
+    try:
+        return merge_customer_matches([session.execute(query)
+                                       for query in customer_search_queries(owner_id, prefix, limit)], limit)
+    except SQLAlchemyError:
+        print("\033[91mSQLAlchemyError: Could not search customers\033[0m")
+        return None
+
+
+def stage_order(db, prod_owner_id, order_details, customer_details):
+    # adds the order to db without committing; shared by the Flask route and the async API (through run_sync)
+    status = "done"
+    order_total = 0
+    order_id = next_order_id()
+    ordered_at = datetime.now()
+
+    # repeated lines for the same product are merged so every product row is touched once
+    quantities = {}
+    for order in order_details:
+        prod_id = int(order['prod_id'])
+        quantities[prod_id] = quantities.get(prod_id, 0) + int(order['prod_quantity'])
+
+    # the whole cart in one round trip; the row locks (taken in prod_id order to avoid deadlocks)
+    # make concurrent checkouts of the same product wait for each other until commit
+    products = db.scalars(select(Products)
+                          .where(Products.prod_id.in_(quantities), Products.owner_id == prod_owner_id)
+                          .order_by(Products.prod_id)
+                          .with_for_update()).all()
+
+    if len(products) != len(quantities):
+        print("\033[91mOrder references products that do not exist for this owner\033[0m")
+        return "failed"
+
+    stock_updates = []
+    backordered = {}
+    for product in products:
+        quantity = quantities[product.prod_id]
+        # what is on hand ships now; the rest is backordered and filled by the next replenishment
+        shipped = min(max(product.prod_quantity, 0), quantity)
+        backordered[product.prod_id] = quantity - shipped
+
+        if backordered[product.prod_id]:
+            status = "backordered"
+
+        stock_updates.append({'b_prod_id': product.prod_id, 'b_quantity': quantity})
+        order_total += product.prod_price * quantity
+
+    customer_id, new_customer = upsert_customer(db, prod_owner_id, customer_details)
+
+    if stock_updates:
+        # the split is recomputed from the row itself, so the counters stay exact and the shelf never goes
+        # negative even on backends that ignore FOR UPDATE; backordered comes first because MySQL applies
+        # the assignments left to right
+        products_table = Products.__table__
+        on_hand, ordered = products_table.c.prod_quantity, bindparam('b_quantity')
+        shipped = case((on_hand >= ordered, ordered), (on_hand > 0, on_hand), else_=0)
+        db.execute(update(products_table)
+                   .where(products_table.c.prod_id == bindparam('b_prod_id'))
+                   .ordered_values((products_table.c.backordered, products_table.c.backordered + ordered - shipped),
+                                   (products_table.c.prod_quantity, on_hand - shipped)),
+                   stock_updates)
+        db.execute(insert(Orders), [{
+            'order_id': order_id,
+            'prod_id': prod_id,
+            'owner_id': prod_owner_id,
+            'sold_prod_quantity': quantity,
+            'ordered_at': ordered_at,
+            'customer_id': customer_id,
+            'backordered_quantity': backordered[prod_id],
+        } for prod_id, quantity in quantities.items()])
+        bump_sales_rollups(db, prod_owner_id, ordered_at,
+                           [(product.prod_id, product.prod_price * quantities[product.prod_id],
+                             quantities[product.prod_id]) for product in products])
+
+    bump_owner_stats(prod_owner_id, customers=1 if new_customer else 0, sales=order_total,
+                     touched=('products', 'sales'), db=db)
+    return status
 
 
 def add_order_in_db(prod_owner_id, order_details, customer_details):
     try:
-        status = ""
-        order_id = int(datetime.now().strftime('%H%M%S') + str(random.randint(0, 10)))
-
-        for order in order_details:
-            # inserting into the db
-            new_order = Orders(order_id=order_id,
-                               prod_id=order['prod_id'],
-                               owner_id=prod_owner_id,
-                               sold_prod_quantity=order['prod_quantity'])
-
-            # reducing quantity from the available stock
-            product = session.query(Products).filter_by(prod_id=order['prod_id']).first()
-
-            if product and product.prod_quantity >= int(order['prod_quantity']):
-                product.prod_quantity -= int(order['prod_quantity'])
-            else:
-                product.prod_quantity += 100
-                product.prod_quantity -= int(order['prod_quantity'])
-                status += "stock"
-
-            session.add(new_order)
-
-        new_customer = Customers(
-            owner_id=prod_owner_id,
-            customer_name=customer_details['name'],
-            customer_email=customer_details['email'],
-            customer_address=customer_details['address'],
-            customer_city=customer_details['city'],
-            customer_state=customer_details['state'],
-            customer_zip=customer_details['zip']
-        )
-
-        session.add(new_customer)
+        status = stage_order(session, prod_owner_id, order_details, customer_details)
 
-        session.commit()
-        if status:
+        if status == "failed":
+            session.rollback()
             return status
-        else:
-            return "done"
+
+        session.commit()
+        return status
     except IntegrityError:
         session.rollback()
         print("\033[91mIntegrityError: Error while inserting new order details\033[0m")
@@ -210,30 +727,237 @@ def add_order_in_db(prod_owner_id, order_details, customer_details):
         return "failed"
 
 
-def get_card_data(owner_id):
-    result = {}
+def upsert_sales_rollups(db, rows):
+    # adds to existing buckets; one executemany, with the dialect's own upsert since the buckets may not exist yet
+    table = SalesRollup.__table__
+    rows = sorted(rows, key=lambda row: (row['granularity'], row['prod_id'], row['bucket_start']))
+
+    if db.get_bind().dialect.name == 'mysql':
+        statement = mysql_insert(table)
+        statement = statement.on_duplicate_key_update(revenue=table.c.revenue + statement.inserted.revenue,
+                                                      units=table.c.units + statement.inserted.units)
+    else:
+        statement = sqlite_insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.owner_id, table.c.granularity, table.c.prod_id, table.c.bucket_start],
+            set_={'revenue': table.c.revenue + statement.excluded.revenue,
+                  'units': table.c.units + statement.excluded.units})
+
+    db.execute(statement, rows)
+
+
+def bump_sales_rollups(db, owner_id, ordered_at, lines):
+    # lines are (prod_id, revenue, units); every bucket gets the per-product rows and the owner total (prod_id 0)
+    total_revenue = sum(revenue for _, revenue, _ in lines)
+    total_units = sum(units for _, _, units in lines)
+
+    upsert_sales_rollups(db, [{
+        'owner_id': int(owner_id),
+        'granularity': granularity,
+        'prod_id': prod_id,
+        'bucket_start': bucket_start(ordered_at, granularity),
+        'revenue': revenue,
+        'units': units,
+    } for granularity in ROLLUP_GRANULARITIES
+        for prod_id, revenue, units in [(0, total_revenue, total_units)] + list(lines)])
+
+
+def rebuild_sales_rollups(db, owner_id=None, batch_size=10000):
+    # recomputes the buckets from the raw orders; orders from before ordered_at existed cannot be placed
+    owner_ids = [int(owner_id)] if owner_id is not None else db.scalars(select(Owners.id)).all()
+
+    for owner in owner_ids:
+        db.execute(SalesRollup.__table__.delete().where(SalesRollup.owner_id == owner))
+
+        buckets = {}
+        lines = db.execute(select(Orders.prod_id, Orders.sold_prod_quantity, Orders.ordered_at, Products.prod_price)
+                           .join(Products, Products.prod_id == Orders.prod_id)
+                           .where(Orders.owner_id == owner, Orders.ordered_at.is_not(None))
+                           .execution_options(yield_per=batch_size))
+        for line in lines:
+            revenue = line.prod_price * line.sold_prod_quantity
+            for granularity in ROLLUP_GRANULARITIES:
+                start = bucket_start(line.ordered_at, granularity)
+                for prod_id in (0, line.prod_id):
+                    bucket = buckets.setdefault((granularity, prod_id, start), [0, 0])
+                    bucket[0] += revenue
+                    bucket[1] += line.sold_prod_quantity
+
+        rows = [{'owner_id': owner, 'granularity': granularity, 'prod_id': prod_id, 'bucket_start': start,
+                 'revenue': revenue, 'units': units}
+                for (granularity, prod_id, start), (revenue, units) in buckets.items()]
+        for position in range(0, len(rows), batch_size):
+            db.execute(insert(SalesRollup.__table__), rows[position:position + batch_size])
+
+    return len(owner_ids)
+
+
+def sales_trend_query(owner_id, granularity, start, end, prod_id=None):
+    return (select(SalesRollup.bucket_start, SalesRollup.revenue, SalesRollup.units)
+            .where(SalesRollup.owner_id == owner_id,
+                   SalesRollup.granularity == granularity,
+                   SalesRollup.prod_id == (prod_id or 0),
+                   SalesRollup.bucket_start >= bucket_start(start, granularity),
+                   SalesRollup.bucket_start < end)
+            .order_by(SalesRollup.bucket_start))
+
+
+def fill_sales_trend(rows, granularity, start, end):
+    # one point per bucket in the range, zero where nothing was sold
+    stored = {row.bucket_start: row for row in rows}
+    series = []
+
+    moment = bucket_start(start, granularity)
+    while moment < end:
+        row = stored.get(moment)
+        series.append({
+            'bucket': moment.isoformat(),
+            'revenue': row.revenue if row is not None else 0,
+            'units': row.units if row is not None else 0,
+        })
+        moment = next_bucket(moment, granularity)
+    return series
+
+
+@replica_reads()
+def get_sales_trend(owner_id, granularity, start, end, prod_id=None):
+    return fill_sales_trend(session.execute(sales_trend_query(owner_id, granularity, start, end, prod_id)),
+                            granularity, start, end)
+
+
+def compute_owner_stats(owner_id=None, db=session):
+    # recomputes the card aggregates from the raw tables, for one owner or for all of them
+    if owner_id is not None:
+        owner_id = int(owner_id)
+
+    def per_owner(query, owner_column):
+        if owner_id is not None:
+            query = query.where(owner_column == owner_id)
+        return dict(db.execute(query.group_by(owner_column)).all())
+
+    products = per_owner(select(Products.owner_id, func.count()), Products.owner_id)
+    customers = per_owner(select(Customers.owner_id, func.count()), Customers.owner_id)
+    sales = per_owner(select(Orders.owner_id, func.sum(Products.prod_price * Orders.sold_prod_quantity))
+                      .join(Products, Products.prod_id == Orders.prod_id), Orders.owner_id)
+
+    owner_ids = [owner_id] if owner_id is not None else db.scalars(select(Owners.id)).all()
+
+    return {owner: {
+        'count_products': products.get(owner, 0),
+        'count_customers': customers.get(owner, 0),
+        'total_sales': int(sales.get(owner) or 0),
+    } for owner in owner_ids}
+
+
+def bump_owner_stats(owner_id, products=0, customers=0, sales=0, touched=(), db=session):
+    # runs inside the caller's transaction, so the aggregates and the data versions of the `touched` scopes
+    # commit or roll back with the write itself
+    versions = {f'{scope}_version': getattr(OwnerStats, f'{scope}_version') + 1 for scope in touched}
+    if touched:
+        versions['modified_at'] = datetime.now()
+
+    bump = (update(OwnerStats)
+            .where(OwnerStats.owner_id == owner_id)
+            .values(count_products=OwnerStats.count_products + products,
+                    count_customers=OwnerStats.count_customers + customers,
+                    total_sales=OwnerStats.total_sales + sales,
+                    **versions))
+
+    if db.execute(bump).rowcount == 0:
+        # first write for this owner: the raw tables already include the pending rows. When a concurrent first
+        # write inserts the row before us, ours is ignored and the increments go onto theirs instead
+        row = dict(owner_id=int(owner_id), **compute_owner_stats(int(owner_id), db=db)[int(owner_id)],
+                   **{column: 1 for column in versions if column != 'modified_at'},
+                   modified_at=versions.get('modified_at'))
+        if db.get_bind().dialect.name == 'mysql':
+            statement = mysql_insert(OwnerStats).values(row).prefix_with('IGNORE')
+        else:
+            statement = sqlite_insert(OwnerStats).values(row).on_conflict_do_nothing(index_elements=['owner_id'])
+        if db.execute(statement).rowcount == 0:
+            db.execute(bump)
+
+
+def data_version(scope):
+    # reads the owner's data version of `scope`, which the owner cache stores a listing under. It is read before
+    # the listing, so a listing is never older than its key; None (a database error) skips the cache
+    column = getattr(OwnerStats, f'{scope}_version')
+
+    def version(owner_id):
+        try:
+            return session.scalar(select(column).where(OwnerStats.owner_id == owner_id)) or 0
+        except SQLAlchemyError:
+            session.rollback()
+            print("\033[91mSQLAlchemyError: Could not read the data version\033[0m")
+            return None
+    return version
+
+
+@replica_reads()
+def get_owner_versions(owner_id):
+    # the data versions by scope and the time of the last bump, in one primary key read
+    row = session.execute(select(OwnerStats.products_version, OwnerStats.sales_version,
+                                 OwnerStats.employees_version, OwnerStats.outlets_version, OwnerStats.modified_at)
+                          .where(OwnerStats.owner_id == int(owner_id))).one_or_none()
+
+    if row is None:
+        return dict.fromkeys(VERSION_SCOPES, 0), None
+    return {scope: getattr(row, f'{scope}_version') for scope in VERSION_SCOPES}, row.modified_at
+
+
+def rebuild_owner_stats(verify_only=False):
+    # returns the owners whose stored aggregates drifted from the raw tables, fixing them unless verify_only, and
+    # the owners without a row yet. Those are counted live until their first write creates it, so they never drift
+    drifted, missing = {}, []
+
+    for owner_id, expected in compute_owner_stats().items():
+        stats = session.get(OwnerStats, owner_id)
+        if stats is None:
+            missing.append(owner_id)
+            continue
+
+        stored = {
+            'count_products': stats.count_products,
+            'count_customers': stats.count_customers,
+            'total_sales': stats.total_sales,
+        }
+
+        if stored != expected:
+            drifted[owner_id] = {'stored': stored, 'expected': expected}
+            if not verify_only:
+                session.merge(OwnerStats(owner_id=owner_id, **expected))
+                session.flush()
+                bump_owner_stats(owner_id, touched=('products', 'sales'))
+
+    if verify_only:
+        session.rollback()
+    else:
+        session.commit()
 
-    count_products = session.query(Products).filter(Products.owner_id == owner_id).count()
-    count_customers = session.query(Customers).filter(Customers.owner_id == owner_id).count()
-    query_orders = session.query(Orders.order_id).filter(Orders.owner_id == owner_id).distinct().all()
+    return drifted, missing
 
-    total_sales = 0
 
-    for index, order in enumerate(query_orders, start=1):
+@replica_reads()
+def get_card_data(owner_id):
+    try:
+        owner_id = int(owner_id)
+    except (TypeError, ValueError):
+        print("\033[91mValueError: Owner id must be a number\033[0m")
+        return {'count_products': 0, 'count_customers': 0, 'total_sales': 0}
 
-        query_products = session.query(Orders.prod_id).filter(Orders.order_id == order.order_id).all()
-        product_list = [prod.prod_id for prod in query_products]
+    stats = session.get(OwnerStats, owner_id)
 
-        for prod in product_list:
-            query_price = session.query(Products.prod_price).filter(Products.prod_id == prod).one()
-            total_sales += query_price[0]
+    if stats is None:
+        # no order or product yet (or an unknown owner): counted from the raw tables, the row is written by the
+        # owner's first write rather than by this read
+        return compute_owner_stats(owner_id)[owner_id]
 
     return {
-        'count_products': count_products,
-        'count_customers': count_customers,
-        'total_sales': total_sales
+        'count_products': stats.count_products,
+        'count_customers': stats.count_customers,
+        'total_sales': stats.total_sales
     }
 
+
 def add_product_in_db(prod_owner_id, prod_name, prod_price, prod_quantity, prod_img):
     try:
         new_prod = Products(owner_id=prod_owner_id,
@@ -242,7 +966,9 @@ def add_product_in_db(prod_owner_id, prod_name, prod_price, prod_quantity, prod_
                             prod_quantity=prod_quantity,
                             prod_image=prod_img)
         session.add(new_prod)
+        bump_owner_stats(prod_owner_id, products=1, touched=('products',))
         session.commit()
+        schedule_variants(prod_img)
         return True
     except IntegrityError:
         session.rollback()
@@ -250,21 +976,24 @@ def add_product_in_db(prod_owner_id, prod_name, prod_price, prod_quantity, prod_
         return False
 
 
+def product_details(prod):
+    return {
+        'prod_id': prod.prod_id,
+        'prod_name': prod.prod_name,
+        'prod_price': prod.prod_price,
+        'prod_quantity': prod.prod_quantity,
+        'prod_image': prod.prod_image,
+        'reorder_point': prod.reorder_point,
+        'reorder_quantity': prod.reorder_quantity,
+        'backordered': prod.backordered,
+    }
+
+
+@owner_cache.cached('products', data_version('products'))
 def retrieve_products(owner_id):
     try:
         all_prods = session.query(Products).filter(Products.owner_id == owner_id).all()
-        response = []
-
-        for prod in all_prods:
-            response.append({
-                'prod_id': prod.prod_id,
-                'prod_name': prod.prod_name,
-                'prod_price': prod.prod_price,
-                'prod_quantity': prod.prod_quantity,
-                'prod_image': prod.prod_image,
-            })
-
-        return response
+        return [product_details(prod) for prod in all_prods]
     except IntegrityError:
         session.rollback()
         print("\033[91mIntegrityError: Something went wrong\033[0m")
@@ -275,11 +1004,25 @@ def retrieve_products(owner_id):
         return False
 
 
+@replica_reads()
+def retrieve_products_page(owner_id, limit):
+    # the owner's first `limit` products, for pages that cannot show a whole large catalog
+    try:
+        prods = session.scalars(select(Products)
+                                .where(Products.owner_id == int(owner_id))
+                                .order_by(Products.prod_id)
+                                .limit(limit))
+        return [product_details(prod) for prod in prods]
+    except SQLAlchemyError:
+        session.rollback()
+        print("\033[91mSQLAlchemyError: Something went wrong\033[0m")
+        return False
+
+
 def insert_owner_into_db(details):
     user_name = details['name']
     user_email = details['email']
-    user_password = details['password'].encode('utf-8')
-    hashed_user_password = bcrypt.hashpw(user_password, bcrypt.gensalt())
+    hashed_user_password = hash_password(details['password'])  # raises PasswordPoolBusy when saturated
 
     try:
         new_owner = Owners(name=user_name, email=user_email, password=hashed_user_password)
@@ -302,14 +1045,15 @@ def check_presence_in_db(details):
 
 def verify_signin_with_db(details):
     user_email = details['email']
-    user_password = details['password'].encode('utf-8')
+    user_password = details['password']
     get_details_of_owner_with_email = select(Owners).where(Owners.email == user_email)
     result = session.execute(get_details_of_owner_with_email).fetchone()
 
     if result is not None:
-        password = result[0].password.encode('utf-8')
-        if bcrypt.checkpw(user_password, password):
-            row = result[0]
+        row = result[0]
+        if check_password(user_password, row.password):  # raises PasswordPoolBusy when saturated
+            if needs_rehash(row.password):
+                upgrade_password_hash(row, user_password)
             name = row.name
             id = row.id
             return id, name
@@ -317,6 +1061,19 @@ def verify_signin_with_db(details):
     return None
 
 
+def upgrade_password_hash(owner, password):
+    # the configured cost changed since this hash was made; the login itself must not fail because of it
+    try:
+        owner.password = hash_password(password)
+        session.commit()
+    except PasswordPoolBusy:
+        pass
+    except SQLAlchemyError:
+        session.rollback()
+        print("\033[91mCould not upgrade password hash\033[0m")
+
+
+@owner_cache.cached('store_loc', data_version('outlets'))
 def retrieve_store_loc(owner_id):
     try:
         get_store_list = (session
@@ -342,6 +1099,7 @@ def add_store_loc(store_owner_id, store_lat, store_lng):
                           lng=store_lng,
                           owner_id=store_owner_id)
         session.add(new_loc)
+        bump_owner_stats(store_owner_id, touched=('outlets',))
         session.commit()
         return True
     except IntegrityError:
@@ -350,6 +1108,7 @@ def add_store_loc(store_owner_id, store_lat, store_lng):
         return False
 
 
+@owner_cache.cached('employees', data_version('employees'))
 def retrieve_employees_data(owner_id):
     try:
         get_employee_list = (session
@@ -379,6 +1138,7 @@ def add_employee_in_db(employee_owner_id, employee_name, employee_post, employee
                                  salary=employee_salary,
                                  owner_id=employee_owner_id)
         session.add(new_employee)
+        bump_owner_stats(employee_owner_id, touched=('employees',))
         session.commit()
         return True
     except IntegrityError:
@@ -390,6 +1150,7 @@ def add_employee_in_db(employee_owner_id, employee_name, employee_post, employee
 def remove_employee(id, owner_id):
     try:
         session.query(Employees).filter(and_(Employees.id == id, Employees.owner_id == owner_id)).delete()
+        bump_owner_stats(owner_id, touched=('employees',))
         session.commit()
         return True
     except IntegrityError:
@@ -404,8 +1165,13 @@ def remove_employee(id, owner_id):
 
 def remove_product(prod_id, owner_id):
     try:
-        print("Triggered remove_product")
-        session.query(Products).filter(and_(Products.prod_id == prod_id, Products.owner_id == owner_id)).delete()
+        session.execute(delete(Replenishments)
+                        .where(Replenishments.prod_id == prod_id, Replenishments.owner_id == owner_id))
+        removed = (session
+                   .query(Products)
+                   .filter(and_(Products.prod_id == prod_id, Products.owner_id == owner_id))
+                   .delete())
+        bump_owner_stats(owner_id, products=-removed, touched=('products',))
         session.commit()
         return True
     except IntegrityError:
@@ -418,17 +1184,10 @@ def remove_product(prod_id, owner_id):
         return False
 
 
+@owner_cache.cached('stock', data_version('products'))
 def get_items_in_stock(owner_id):
-    detail_of_items_in_stock = session.query(Products.prod_name).filter(Products.owner_id == owner_id).all()
-    list_items_in_stock = []
-
-    for prod_name in detail_of_items_in_stock:
-        list_items_in_stock.append(prod_name[0])
-
-    amount_of_items_in_stock = session.query(Products.prod_quantity).filter(Products.owner_id == owner_id).all()
-    list_quantity_of_items = []
-
-    for prod_quantity in amount_of_items_in_stock:
-        list_quantity_of_items.append(prod_quantity[0])
+    rows = session.execute(select(Products.prod_name, Products.prod_quantity)
+                           .where(Products.owner_id == owner_id)
+                           .order_by(Products.prod_id)).all()
 
-    return list_items_in_stock, list_quantity_of_items
+    return [row.prod_name for row in rows], [row.prod_quantity for row in rows]
@@ -0,0 +1,193 @@
+import bisect
+import random
+import time
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+from sqlalchemy import create_engine, event, insert, select, update, delete, func, and_
+from sqlalchemy.pool import NullPool
+
+import database
+from database import Owners, Outlets, Employees, Products, Orders, Customers, OwnerStats
+from id_generator import EPOCH_MS, MAX_WORKER_ID, SEQUENCE_BITS, TIMESTAMP_SHIFT
+from passwords import hash_password
+
+# every generated owner signs in with owner<n>@bench.example / PASSWORD
+PASSWORD = 'bench'
+POSTS = ('cashier', 'stock clerk', 'store manager', 'driver', 'sales associate')
+STATES = ('Karnataka', 'Maharashtra', 'Tamil Nadu', 'Gujarat', 'West Bengal', 'Punjab', 'Kerala', 'Goa')
+# product names are built from these, so searches see a realistic mix of shared and rare words
+BRANDS = ('Amul', 'Tata', 'Nestle', 'Britannia', 'Haldiram', 'Dabur', 'Parle', 'Patanjali', 'Himalaya', 'Surf',
+          'Colgate', 'Godrej', 'Mother Dairy', 'Aashirvaad', 'Fortune', 'MTR', 'Everest', 'Cadbury', 'Bru', 'Lijjat')
+KINDS = ('Basmati Rice', 'Green Tea', 'Masala Chai', 'Instant Coffee', 'Butter', 'Paneer', 'Ghee', 'Biscuits',
+         'Toothpaste', 'Shampoo', 'Detergent', 'Soap', 'Chocolate', 'Namkeen', 'Atta', 'Sunflower Oil', 'Honey',
+         'Pickle', 'Papad', 'Noodles', 'Cornflakes', 'Jam', 'Ketchup', 'Turmeric', 'Garam Masala')
+SIZES = ('100g', '250g', '500g', '1kg', '5kg', '200ml', '500ml', '1L', 'Pack of 6', 'Family Pack')
+
+
+def generator_engine(url):
+    # a private engine, so the bulk-load pragmas never reach the connections the app uses
+    engine = create_engine(url, poolclass=NullPool)
+
+    if engine.dialect.name == 'sqlite':
+        @event.listens_for(engine, 'connect')
+        def bulk_pragmas(connection, _):
+            connection.execute("PRAGMA synchronous=OFF")
+            connection.execute("PRAGMA cache_size=-262144")
+
+    return engine
+
+
+def insert_chunks(connection, table, rows, chunk_size):
+    # one executemany and one commit per chunk, so neither memory nor the transaction grows with the row count
+    batch, written = [], 0
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= chunk_size:
+            connection.execute(insert(table), batch)
+            connection.commit()
+            written += len(batch)
+            batch = []
+    if batch:
+        connection.execute(insert(table), batch)
+        connection.commit()
+        written += len(batch)
+    return written
+
+
+def next_id(connection, column):
+    return (connection.scalar(select(func.max(column))) or 0) + 1
+
+
+def skewed(rng, count):
+    # an index in range(count) where low indexes are picked far more often: a few bestsellers, a long tail
+    return int(count * rng.random() ** 3)
+
+
+def clear(connection):
+    for model in (database.Replenishments, database.SalesRollup, OwnerStats, Orders, Customers, Products,
+                  Employees, Outlets, Owners):
+        connection.execute(delete(model))
+    connection.commit()
+
+
+def generate(url, owners=1000, products=50000, orders=1000000, lines=3, customers=100000, employees=10000,
+             outlets=10000, days=365, seed_value=42, chunk_size=20000, reset=False, log=print):
+    # products, customers, employees and outlets are spread evenly over the owners; orders follow a Pareto
+    # distribution over the owners (a few large stores, many small ones) and are spaced over the last `days`
+    rng = random.Random(seed_value)
+    engine = generator_engine(url)
+    per_owner = {name: max(1, total // owners) for name, total in
+                 (('products', products), ('customers', customers), ('employees', employees),
+                  ('outlets', outlets))}
+    counts = {}
+    started = time.perf_counter()
+
+    with engine.connect() as connection:
+        if reset:
+            clear(connection)
+
+        first = {
+            'owner': next_id(connection, Owners.id),
+            'product': next_id(connection, Products.prod_id),
+            'customer': next_id(connection, Customers.customer_id),
+        }
+        password = hash_password(PASSWORD)
+
+        def owner_rows():
+            for index in range(owners):
+                owner_id = first['owner'] + index
+                yield {'id': owner_id, 'name': f'owner{owner_id}', 'email': f'owner{owner_id}@bench.example',
+                       'password': password}
+
+        def product_rows():
+            for index in range(owners * per_owner['products']):
+                owner_index, position = divmod(index, per_owner['products'])
+                yield {'prod_id': first['product'] + index, 'owner_id': first['owner'] + owner_index,
+                       'prod_name': f'{rng.choice(BRANDS)} {rng.choice(KINDS)} {rng.choice(SIZES)} {position}',
+                       'prod_price': rng.randint(10, 5000),
+                       'prod_quantity': rng.randint(0, 500), 'prod_image': 'notebook.jpg'}
+
+        def customer_rows():
+            for index in range(owners * per_owner['customers']):
+                owner_index = index // per_owner['customers']
+                customer_id = first['customer'] + index
+                name = f'customer {customer_id}'
+                yield {'customer_id': customer_id, 'owner_id': first['owner'] + owner_index,
+                       'customer_name': name, 'customer_email': f'customer{customer_id}@example.com',
+                       'customer_address': f'{rng.randint(1, 999)} Main Street',
+                       'customer_city': 'Bengaluru', 'customer_state': rng.choice(STATES),
+                       'customer_zip': rng.randint(100000, 999999),
+                       'email_key': f'customer{customer_id}@example.com', 'name_key': name, 'order_count': 0}
+
+        def employee_rows():
+            for index in range(owners * per_owner['employees']):
+                yield {'owner_id': first['owner'] + index // per_owner['employees'],
+                       'name': f'employee {index}', 'post': rng.choice(POSTS),
+                       'salary': float(rng.randint(15, 120) * 1000)}
+
+        def outlet_rows():
+            # each owner's outlets cluster around a home city
+            for owner_index in range(owners):
+                lat, lng = rng.uniform(8, 34), rng.uniform(68, 96)
+                for _ in range(per_owner['outlets']):
+                    yield {'owner_id': first['owner'] + owner_index,
+                           'lat': rng.gauss(lat, 0.2), 'lng': rng.gauss(lng, 0.2)}
+
+        def order_rows():
+            now_ms = int(datetime.now().timestamp() * 1000)
+            start_ms = max(int((datetime.now() - timedelta(days=days)).timestamp() * 1000), EPOCH_MS)
+            mean_gap = max((now_ms - start_ms) / max(orders, 1), 1)
+            weights = list(accumulate(rng.paretovariate(1.16) for _ in range(owners)))
+            moment = start_ms
+
+            for _ in range(orders):
+                # strictly increasing milliseconds make the ids unique snowflakes matching ordered_at; the
+                # highest worker id keeps them apart from ids a live worker would issue for the same instant
+                moment = max(moment + 1, moment + int(rng.expovariate(1 / mean_gap)))
+                order_id = ((moment - EPOCH_MS) << TIMESTAMP_SHIFT) | (MAX_WORKER_ID << SEQUENCE_BITS)
+                ordered_at = datetime.fromtimestamp(moment / 1000)
+                owner_index = bisect.bisect(weights, rng.random() * weights[-1])
+                customer_id = first['customer'] + owner_index * per_owner['customers'] + \
+                    skewed(rng, per_owner['customers'])
+
+                chosen = set()
+                for _ in range(min(rng.randint(1, lines), per_owner['products'])):
+                    chosen.add(skewed(rng, per_owner['products']))
+                for position in chosen:
+                    yield {'order_id': order_id, 'owner_id': first['owner'] + owner_index,
+                           'prod_id': first['product'] + owner_index * per_owner['products'] + position,
+                           'sold_prod_quantity': rng.randint(1, 5), 'ordered_at': ordered_at,
+                           'customer_id': customer_id}
+
+        # parents before children, for backends that enforce the foreign keys
+        for name, model, rows in (('owners', Owners, owner_rows()), ('products', Products, product_rows()),
+                                  ('customers', Customers, customer_rows()),
+                                  ('employees', Employees, employee_rows()), ('outlets', Outlets, outlet_rows()),
+                                  ('order lines', Orders, order_rows())):
+            table_started = time.perf_counter()
+            counts[name] = insert_chunks(connection, model.__table__, rows, chunk_size)
+            elapsed = time.perf_counter() - table_started
+            log(f"{name:<12}{counts[name]:>12} rows {elapsed:>8.1f}s {counts[name] / max(elapsed, 1e-9):>12.0f} rows/s")
+
+        # the derived tables, computed the same way the maintenance commands do
+        derived_started = time.perf_counter()
+        customers_table, orders_table = Customers.__table__, Orders.__table__
+        connection.execute(update(customers_table)
+                           .where(customers_table.c.customer_id >= first['customer'])
+                           .values(order_count=select(func.count(func.distinct(orders_table.c.order_id)))
+                                   .where(and_(orders_table.c.owner_id == customers_table.c.owner_id,
+                                               orders_table.c.customer_id == customers_table.c.customer_id))
+                                   .scalar_subquery()))
+        database.rebuild_sales_rollups(connection)
+        stats = database.compute_owner_stats(db=connection)
+        connection.execute(delete(OwnerStats))
+        connection.execute(insert(OwnerStats), [{'owner_id': owner_id, **values}
+                                                for owner_id, values in stats.items()])
+        connection.commit()
+        log(f"{'derived':<12}{'':>12}      {time.perf_counter() - derived_started:>8.1f}s "
+            f"(customer order counts, sales rollups, owner stats)")
+
+    engine.dispose()
+    counts['seconds'] = round(time.perf_counter() - started, 1)
+    return counts
@@ -0,0 +1,130 @@
+import csv
+import io
+import json
+import zlib
+from datetime import datetime
+
+from sqlalchemy import select
+
+from database import Orders, Products, Customers, session, iter_sales_report, replica_reads
+
+ROWS_PER_CHUNK = 500
+
+
+def order_rows(owner_id, batch_size):
+    query = (select(Orders.order_id, Orders.prod_id, Products.prod_name, Orders.sold_prod_quantity,
+                    Products.prod_price, Orders.ordered_at, Orders.customer_id)
+             .join(Products, Products.prod_id == Orders.prod_id)
+             .where(Orders.owner_id == owner_id)
+             .order_by(Orders.order_id, Orders.order_val))
+    # yield_per streams from a server-side cursor instead of buffering the whole result
+    for line in session.execute(query.execution_options(yield_per=batch_size)):
+        yield line._asdict()
+
+
+def customer_rows(owner_id, batch_size):
+    query = (select(Customers.customer_id, Customers.customer_name, Customers.customer_email,
+                    Customers.customer_address, Customers.customer_city, Customers.customer_state,
+                    Customers.customer_zip, Customers.order_count)
+             .where(Customers.owner_id == owner_id)
+             .order_by(Customers.customer_id))
+    for customer in session.execute(query.execution_options(yield_per=batch_size)):
+        yield customer._asdict()
+
+
+def sales_report_rows(owner_id, batch_size):
+    return iter_sales_report(owner_id, batch_size=batch_size)
+
+
+EXPORTS = {
+    'orders': (order_rows,
+               ['order_id', 'prod_id', 'prod_name', 'sold_prod_quantity', 'prod_price', 'ordered_at',
+                'customer_id']),
+    'customers': (customer_rows,
+                  ['customer_id', 'customer_name', 'customer_email', 'customer_address', 'customer_city',
+                   'customer_state', 'customer_zip', 'order_count']),
+    'sales_report': (sales_report_rows,
+                     ['order_number', 'order_id', 'product_list', 'total_sales']),
+}
+
+
+def csv_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, list):
+        return ' '.join(str(item) for item in value)
+    return value
+
+
+def json_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def csv_chunks(columns, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    writer.writerow(columns)
+    # the header goes out on its own so the download starts before the first query batch arrives
+    yield buffer.getvalue().encode('utf-8')
+    buffer.seek(0)
+    buffer.truncate()
+
+    count = 0
+    for row in rows:
+        writer.writerow([csv_value(row[column]) for column in columns])
+        count += 1
+        if count % ROWS_PER_CHUNK == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def ndjson_chunks(columns, rows):
+    lines = []
+    for count, row in enumerate(rows, start=1):
+        record = {column: row[column] for column in columns}
+        # order ids are 64-bit and would lose precision as JavaScript numbers
+        if 'order_id' in record:
+            record['order_id'] = str(record['order_id'])
+        lines.append(json.dumps(record, default=json_value))
+
+        # the first row goes out on its own, so the download starts with the first query batch rather than
+        # after ROWS_PER_CHUNK rows
+        if count == 1 or len(lines) == ROWS_PER_CHUNK:
+            yield ('\n'.join(lines) + '\n').encode('utf-8')
+            lines = []
+
+    if lines:
+        yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+    for index, chunk in enumerate(chunks):
+        compressed = compressor.compress(chunk)
+        # the first chunk (the CSV header or the first JSON row) is flushed rather than held in the compressor
+        if index == 0:
+            compressed += compressor.flush(zlib.Z_SYNC_FLUSH)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def replica_rows(fetch_rows, owner_id, batch_size):
+    # an export is one long read, the kind that belongs on a replica
+    with replica_reads():
+        yield from fetch_rows(owner_id, batch_size)
+
+
+def export_chunks(owner_id, kind, file_format, compress=False, batch_size=1000):
+    fetch_rows, columns = EXPORTS[kind]
+    formatter = csv_chunks if file_format == 'csv' else ndjson_chunks
+    chunks = formatter(columns, replica_rows(fetch_rows, owner_id, batch_size))
+    return gzip_chunks(chunks) if compress else chunks
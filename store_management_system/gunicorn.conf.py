@@ -0,0 +1,46 @@
+import multiprocessing
+import os
+
+import id_generator
+
+# at most one order id slot per worker, with as many spare for a reload (see id_generator)
+MAX_WORKERS = id_generator.WORKER_SLOTS // 2
+
+# every setting can be overridden from the environment, e.g. WEB_WORKERS=8 WEB_THREADS=2
+bind = os.getenv('WEB_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('WEB_WORKERS', min(multiprocessing.cpu_count() * 2 + 1, MAX_WORKERS)))
+worker_class = os.getenv('WEB_WORKER_CLASS', 'gthread')
+threads = int(os.getenv('WEB_THREADS', 4))
+timeout = int(os.getenv('WEB_TIMEOUT', 30))
+graceful_timeout = int(os.getenv('WEB_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('WEB_KEEPALIVE', 5))
+max_requests = int(os.getenv('WEB_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.getenv('WEB_MAX_REQUESTS_JITTER', 100))
+preload_app = os.getenv('WEB_PRELOAD', 'false').lower() in ('1', 'true', 'yes')
+
+accesslog = os.getenv('WEB_ACCESS_LOG', '-')
+errorlog = '-'
+
+
+def on_starting(server):
+    if server.cfg.workers > MAX_WORKERS:
+        raise RuntimeError(f"WEB_WORKERS is {server.cfg.workers}, at most {MAX_WORKERS} workers get an order id slot")
+
+
+def pre_fork(server, worker):
+    # the lowest slot no live worker holds, so however often max_requests recycles the workers their order ids
+    # stay within this host's slots; the worker object is copied into the child by fork()
+    taken = {getattr(live, 'order_id_slot', None) for live in server.WORKERS.values()}
+    free = [slot for slot in range(id_generator.WORKER_SLOTS) if slot not in taken]
+    if not free:
+        raise RuntimeError(f"all {id_generator.WORKER_SLOTS} order id slots are taken by live workers")
+    worker.order_id_slot = free[0]
+
+
+def post_fork(server, worker):
+    # the engine is created lazily, but if the master touched the database before forking (preload_app),
+    # drop the inherited connections so each worker opens its own sockets instead of sharing the parent's
+    import database
+    database.dispose_engine()
+
+    id_generator.configure(id_generator.worker_id(id_generator.host_id(), worker.order_id_slot))
@@ -0,0 +1,110 @@
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+# 64-bit snowflake layout: | 41 bits ms since EPOCH_MS | 10 bits worker id | 12 bits sequence |
+EPOCH_MS = 1696118400000  # 2023-10-01T00:00:00Z
+WORKER_ID_BITS = 10
+SEQUENCE_BITS = 12
+
+MAX_WORKER_ID = (1 << WORKER_ID_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+TIMESTAMP_SHIFT = WORKER_ID_BITS + SEQUENCE_BITS
+
+# the worker id is the host (ORDER_ID_HOST) in the high bits and a slot on that host in the low ones. gunicorn
+# hands its live workers the slots below WORKER_SLOTS, half of them spare for a reload that briefly runs the old
+# and the new workers side by side; any other process placing orders (the API, the development server, CLI
+# commands) takes one of the slots above, numbered by ORDER_ID_PROCESS
+HOST_BITS = 4
+SLOT_BITS = WORKER_ID_BITS - HOST_BITS
+MAX_HOST = (1 << HOST_BITS) - 1
+WORKER_SLOTS = 48
+PROCESS_SLOTS = (1 << SLOT_BITS) - WORKER_SLOTS
+
+
+class SnowflakeGenerator:
+    def __init__(self, worker_id):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"worker_id must be between 0 and {MAX_WORKER_ID}, got {worker_id}")
+
+        self.worker_id = worker_id
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
+
+    def next_id(self):
+        with self._lock:
+            now = int(time.time() * 1000)
+
+            if now > self._last_ms:
+                self._sequence = 0
+            else:
+                # same millisecond, or the clock stepped backwards: never reuse a timestamp we already issued
+                now = self._last_ms
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # 4096 ids in one millisecond: borrow the next one instead of blocking the request
+                    now += 1
+
+            self._last_ms = now
+            return ((now - EPOCH_MS) << TIMESTAMP_SHIFT) | (self.worker_id << SEQUENCE_BITS) | self._sequence
+
+
+def timestamp_of(snowflake_id):
+    return datetime.fromtimestamp(((snowflake_id >> TIMESTAMP_SHIFT) + EPOCH_MS) / 1000, tz=timezone.utc)
+
+
+def lowest_id_at(moment):
+    # smallest id that can be issued at or after `moment`, for turning a time range into an order_id range scan
+    return max(int(moment.timestamp() * 1000) - EPOCH_MS, 0) << TIMESTAMP_SHIFT
+
+
+_generator = None
+_generator_pid = None
+_configure_lock = threading.Lock()
+
+
+def _install(worker_id):
+    global _generator, _generator_pid
+
+    _generator = SnowflakeGenerator(worker_id)
+    _generator_pid = os.getpid()
+
+
+def configure(worker_id):
+    with _configure_lock:
+        _install(worker_id)
+
+
+def worker_id(host, slot):
+    if not 0 <= host <= MAX_HOST:
+        raise ValueError(f"ORDER_ID_HOST must be between 0 and {MAX_HOST}, got {host}")
+    if not 0 <= slot < 1 << SLOT_BITS:
+        raise ValueError(f"slot must be between 0 and {(1 << SLOT_BITS) - 1}, got {slot}")
+    return (host << SLOT_BITS) | slot
+
+
+def host_id():
+    return int(os.getenv('ORDER_ID_HOST', 0))
+
+
+def process_worker_id(default=0):
+    # for a process not started by gunicorn; two of them on one host must not share an ORDER_ID_PROCESS
+    process = int(os.getenv('ORDER_ID_PROCESS', default))
+    if not 0 <= process < PROCESS_SLOTS:
+        raise ValueError(f"ORDER_ID_PROCESS must be between 0 and {PROCESS_SLOTS - 1}, got {process}")
+    return worker_id(host_id(), WORKER_SLOTS + process)
+
+
+def default_worker_id():
+    return process_worker_id()
+
+
+def next_order_id():
+    # a generator inherited through fork() would repeat the parent's sequence, so it is rebuilt per process
+    if _generator is None or _generator_pid != os.getpid():
+        with _configure_lock:
+            if _generator is None or _generator_pid != os.getpid():
+                _install(default_worker_id())
+    return _generator.next_id()
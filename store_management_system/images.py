@@ -0,0 +1,134 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+from importlib.util import find_spec
+
+logger = logging.getLogger(__name__)
+
+current_directory = os.path.dirname(os.path.abspath(__file__))
+
+SOURCE_DIR = os.path.join(current_directory, 'static', 'images', 'card_images')
+VARIANT_DIR = os.getenv('IMAGE_VARIANT_DIR', os.path.join(current_directory, 'image_variants'))
+
+# the product cards are 300px high and at most about 400px wide; card2x is for high-density screens
+SIZES = {
+    'card': (400, 300),
+    'card2x': (800, 600),
+}
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 6}),
+    'jpg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+
+def source_path(filename):
+    # product images are plain file names in the card image folder; anything else is not ours to serve
+    if not filename or os.path.basename(filename) != filename or filename.startswith('.'):
+        return None
+    path = os.path.join(SOURCE_DIR, filename)
+    return path if os.path.isfile(path) else None
+
+
+def variant_name(filename, size, fmt):
+    return f"{os.path.splitext(filename)[0]}.{size}.{fmt}"
+
+
+def variant_path(filename, size, fmt):
+    # the variant if it exists and is newer than its source, otherwise None
+    source = source_path(filename)
+    if source is None or size not in SIZES or fmt not in FORMATS:
+        return None
+    path = os.path.join(VARIANT_DIR, variant_name(filename, size, fmt))
+    try:
+        if os.stat(path).st_mtime_ns >= os.stat(source).st_mtime_ns:
+            return path
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def generate_variants(filename):
+    # resizes and crops like the cards' object-fit: cover, then writes every size and format; returns the count
+    from PIL import Image, ImageOps  # optional dependency, only needed to build the variants
+
+    source = source_path(filename)
+    if source is None:
+        return 0
+
+    os.makedirs(VARIANT_DIR, exist_ok=True)
+    with Image.open(source) as original:
+        image = ImageOps.exif_transpose(original).convert('RGB')
+
+    written = 0
+    for size, (width, height) in SIZES.items():
+        # never upscaled: a small source gets the largest box of the card's shape that it can fill
+        scale = min(1, image.width / width, image.height / height)
+        dimensions = (max(1, round(width * scale)), max(1, round(height * scale)))
+        resized = ImageOps.fit(image, dimensions, method=Image.Resampling.LANCZOS)
+        for fmt, (pil_format, options) in FORMATS.items():
+            path = os.path.join(VARIANT_DIR, variant_name(filename, size, fmt))
+            # written aside and renamed, so a request never reads a half-written file
+            temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            resized.save(temporary, pil_format, **options)
+            os.replace(temporary, path)
+            written += 1
+    return written
+
+
+@cache
+def pillow_available():
+    return find_spec('PIL') is not None
+
+
+class VariantPool:
+    # resizing happens off the request threads; a file already queued or being resized is not queued again
+
+    def __init__(self, workers):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='images')
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def submit(self, filename):
+        with self._lock:
+            if filename in self._pending:
+                return None
+            self._pending.add(filename)
+        return self._executor.submit(self._run, filename)
+
+    def _run(self, filename):
+        try:
+            return generate_variants(filename)
+        except Exception:
+            logger.exception("could not build image variants for %s", filename)
+            return 0
+        finally:
+            with self._lock:
+                self._pending.discard(filename)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    # threads do not survive fork(), so each worker process builds its own pool
+    global _pool, _pool_pid
+
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = VariantPool(int(os.getenv('IMAGE_WORKERS', 2)))
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def schedule_variants(filename):
+    # queues the variants of a product image unless they are up to date; without Pillow the originals are served
+    if not pillow_available() or source_path(filename) is None:
+        return None
+    if all(variant_path(filename, size, fmt) for size in SIZES for fmt in FORMATS):
+        return None
+    return get_pool().submit(filename)
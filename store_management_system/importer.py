@@ -0,0 +1,205 @@
+import csv
+import io
+import json
+import math
+import time
+
+from sqlalchemy import insert
+from sqlalchemy.exc import SQLAlchemyError
+
+from database import Products, Employees, Outlets, Customers, session, bump_owner_stats, upsert_customers
+from images import schedule_variants
+
+MAX_REPORTED_ERRORS = 1000
+READ_SIZE = 64 * 1024
+INTEGER_MAX = 2 ** 31 - 1
+
+
+def text(max_length):
+    def convert(value):
+        value = str(value).strip()
+        if not value:
+            raise ValueError("must not be empty")
+        if len(value) > max_length:
+            raise ValueError(f"must be at most {max_length} characters")
+        return value
+    return convert
+
+
+def number(kind, minimum=None, maximum=None):
+    # integers must fit the INTEGER columns they go to, or the database rejects (or SQLite overflows on) the chunk
+    if kind is int:
+        minimum = -INTEGER_MAX - 1 if minimum is None else minimum
+        maximum = INTEGER_MAX if maximum is None else maximum
+
+    def convert(value):
+        try:
+            value = kind(value)
+        except (TypeError, ValueError, OverflowError):
+            raise ValueError(f"must be a{'n integer' if kind is int else ' number'}")
+        if not math.isfinite(value):
+            raise ValueError("must be a finite number")
+        if minimum is not None and value < minimum:
+            raise ValueError(f"must be at least {minimum}")
+        if maximum is not None and value > maximum:
+            raise ValueError(f"must be at most {maximum}")
+        return value
+    return convert
+
+
+# per import kind: the model, its validated columns and the data version a batch bumps
+IMPORTS = {
+    'products': (Products, {
+        'prod_name': text(100),
+        'prod_price': number(int, minimum=0),
+        'prod_quantity': number(int, minimum=0),
+        'prod_image': text(500),
+    }, 'products'),
+    'employees': (Employees, {
+        'name': text(100),
+        'post': text(100),
+        'salary': number(float, minimum=0),
+    }, 'employees'),
+    'outlets': (Outlets, {
+        'lat': number(float, minimum=-90, maximum=90),
+        'lng': number(float, minimum=-180, maximum=180),
+    }, 'outlets'),
+    'customers': (Customers, {
+        'customer_name': text(100),
+        'customer_email': text(100),
+        'customer_address': text(500),
+        'customer_city': text(100),
+        'customer_state': text(100),
+        'customer_zip': number(int, minimum=0),
+    }, 'sales'),
+}
+
+
+def iter_csv_rows(stream):
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+    for row in reader:
+        yield reader.line_num, row
+
+
+def iter_json_rows(stream):
+    # accepts a top-level JSON array or newline-delimited JSON, decoding one element at a time
+    text_stream = io.TextIOWrapper(stream, encoding='utf-8-sig')
+    decoder = json.JSONDecoder()
+    buffer = text_stream.read(READ_SIZE)
+    position = 0
+    row_number = 0
+
+    def skip(chars):
+        nonlocal buffer, position
+        while True:
+            while position < len(buffer) and buffer[position] in chars:
+                position += 1
+            if position < len(buffer):
+                return True
+            buffer, position = text_stream.read(READ_SIZE), 0
+            if not buffer:
+                return False
+
+    if not skip(' \t\r\n'):
+        return
+    in_array = buffer[position] == '['
+    if in_array:
+        position += 1
+
+    while skip(' \t\r\n,'):
+        if in_array and buffer[position] == ']':
+            return
+
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+                break
+            except json.JSONDecodeError as error:
+                # only an element cut off by the end of the buffer is worth another read; anything that fails
+                # before it is malformed, and the rest of the upload is not buffered looking for a place to resync
+                cut_off = error.pos >= len(buffer) - 6 or error.msg.startswith('Unterminated string')
+                more = text_stream.read(READ_SIZE) if cut_off else ''
+                if not more:
+                    raise ValueError(f"malformed JSON after row {row_number}")
+                # keep only the undecoded tail, so memory is bounded by one element plus a read
+                buffer, position = buffer[position:] + more, 0
+
+        position = end
+        row_number += 1
+        yield row_number, value
+
+
+def validate(row, columns):
+    if not isinstance(row, dict):
+        raise ValueError("expected an object with named fields")
+
+    clean = {}
+    for column, convert in columns.items():
+        if row.get(column) is None:
+            raise ValueError(f"{column}: missing")
+        try:
+            clean[column] = convert(row[column])
+        except ValueError as error:
+            raise ValueError(f"{column}: {error}")
+    return clean
+
+
+def import_rows(owner_id, kind, rows, chunk_size):
+    model, columns, scope = IMPORTS[kind]
+    report = {'kind': kind, 'rows': 0, 'inserted': 0, 'merged': 0, 'failed': 0, 'errors': []}
+    batch = []
+    start = time.perf_counter()
+
+    def record_error(row_number, message):
+        report['failed'] += 1
+        if len(report['errors']) < MAX_REPORTED_ERRORS:
+            report['errors'].append({'row': row_number, 'error': message})
+
+    def flush():
+        # one executemany and one commit per chunk; a failing chunk is reported and the import goes on
+        try:
+            if kind == 'customers':
+                # customers are matched on their email, so a known one is updated rather than added again
+                _, created = upsert_customers(session, owner_id, [clean for _, clean in batch])
+                bump_owner_stats(owner_id, customers=created, touched=(scope,))
+                session.commit()
+                report['inserted'] += created
+                report['merged'] += len(batch) - created
+            else:
+                session.execute(insert(model), [clean for _, clean in batch])
+                bump_owner_stats(owner_id, products=len(batch) if kind == 'products' else 0, touched=(scope,))
+                session.commit()
+                report['inserted'] += len(batch)
+                if kind == 'products':
+                    for image in {clean['prod_image'] for _, clean in batch}:
+                        schedule_variants(image)
+        except SQLAlchemyError as error:
+            session.rollback()
+            for row_number, _ in batch:
+                record_error(row_number, f"chunk rejected by the database: {error.__class__.__name__}")
+        batch.clear()
+
+    try:
+        for row_number, row in rows:
+            report['rows'] += 1
+            try:
+                clean = validate(row, columns)
+            except ValueError as error:
+                record_error(row_number, str(error))
+                continue
+
+            clean['owner_id'] = owner_id
+            batch.append((row_number, clean))
+            if len(batch) >= chunk_size:
+                flush()
+    except (ValueError, csv.Error, UnicodeDecodeError) as error:
+        # the file itself is unreadable from here on; what was already imported stays
+        record_error(report['rows'] + 1, f"could not parse file: {error}")
+
+    if batch:
+        flush()
+
+    report['errors_truncated'] = report['failed'] > len(report['errors'])
+    report['seconds'] = round(time.perf_counter() - start, 3)
+    report['rows_per_second'] = round(report['rows'] / report['seconds'], 1) if report['seconds'] else None
+    return report
@@ -0,0 +1,245 @@
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from datetime import datetime
+
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from cache import owner_cache
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 250)
+
+# the same statement this many times in one request is reported as an N+1 pattern
+N_PLUS_ONE_THRESHOLD = int(os.getenv('N_PLUS_ONE_THRESHOLD', 10))
+
+# sampling profiler, off unless PROFILE_SLOW_MS is set
+PROFILE_SLOW_MS = float(os.getenv('PROFILE_SLOW_MS', 0))
+PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', 5))
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+
+# expanded IN lists differ in length from call to call; collapse them so repeats are recognised
+IN_LIST = re.compile(r"\(\s*(?:\?|%s|%\(\w+\)s)(?:\s*,\s*(?:\?|%s|%\(\w+\)s))*\s*\)")
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[position] += 1
+        self.total += 1
+        self.sum += value
+
+
+class Metrics:
+    # per-process registry rendered in the Prometheus text format
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+
+    def observe(self, name, labels, value, buckets):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def inc(self, name, labels, amount=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    @staticmethod
+    def _labels(pairs):
+        if not pairs:
+            return ""
+        escaped = (f'{name}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+                   for name, value in pairs)
+        return "{" + ",".join(escaped) + "}"
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (metric, labels), histogram in sorted(self._histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f"{name}_bucket{self._labels(labels + (('le', bound),))} {count}")
+                    lines.append(f"{name}_bucket{self._labels(labels + (('le', '+Inf'),))} {histogram.total}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{self._labels(labels)} {histogram.total}")
+
+            for name in sorted({name for name, _ in self._counters}):
+                lines.append(f"# TYPE {name} counter")
+                for (metric, labels), value in sorted(self._counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{self._labels(labels)} {value}")
+
+        # the owner cache keeps its own counters; they are exported alongside
+        lines.append("# TYPE owner_cache_events_total counter")
+        for namespace, counters in sorted(owner_cache.stats().items()):
+            for outcome, value in sorted(counters.items()):
+                lines.append(f"owner_cache_events_total"
+                             f"{self._labels((('namespace', namespace), ('outcome', outcome)))} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class RequestStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.statements = Counter()
+        self.samples = Counter() if PROFILE_SLOW_MS else None
+
+
+_current = ContextVar('request_stats', default=None)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    if stats is None or not conn.info.get('query_started'):
+        return
+
+    stats.db_time += time.perf_counter() - conn.info['query_started'].pop()
+    stats.queries += 1
+    # drivers with buffered results (pymysql) report the rows of a SELECT; SQLite and server-side cursors do not
+    if cursor.rowcount and cursor.rowcount > 0:
+        stats.rows += cursor.rowcount
+    if not executemany:
+        stats.statements[IN_LIST.sub("(?)", statement)] += 1
+
+
+class Sampler:
+    # polls the stacks of threads that are serving a request; a background thread, started on first use per process
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.active = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def track(self, stats):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    threading.Thread(target=self._run, name='profiler', daemon=True).start()
+        self.active[threading.get_ident()] = stats
+
+    def untrack(self):
+        self.active.pop(threading.get_ident(), None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            for thread_id, stats in list(self.active.items()):
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                    frame = frame.f_back
+                if stack:
+                    stats.samples[";".join(reversed(stack))] += 1
+
+
+sampler = Sampler(PROFILE_INTERVAL_MS / 1000)
+
+
+def dump_profile(route, stats, elapsed):
+    # folded stacks ("frame;frame;frame count"), the input format of flamegraph.pl and speedscope
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "root"
+    path = os.path.join(PROFILE_DIR, f"{datetime.now():%Y%m%d-%H%M%S-%f}-{name}-{elapsed * 1000:.0f}ms.folded")
+    with open(path, 'w') as folded:
+        for stack, count in stats.samples.most_common():
+            folded.write(f"{stack} {count}\n")
+    logger.info("slow request %s took %.0f ms, profile written to %s", route, elapsed * 1000, path)
+
+
+def start_request():
+    stats = RequestStats()
+    _current.set(stats)
+    if stats.samples is not None:
+        sampler.track(stats)
+
+
+def finish_request(response):
+    stats = _current.get()
+    if stats is None:
+        return response
+
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    method, status = request.method, response.status_code
+
+    if response.direct_passthrough:
+        # files handed to the server's file wrapper never call back on close
+        record(stats, route, method, status)
+    else:
+        # recorded once the server has sent the whole body, so streamed responses are included in the timings
+        response.call_on_close(lambda: record(stats, route, method, status))
+    return response
+
+
+def record(stats, route, method, status):
+    if _current.get() is stats:
+        _current.set(None)
+
+    elapsed = time.perf_counter() - stats.started
+    labels = {'route': route, 'method': method}
+
+    metrics.observe('http_request_duration_seconds', {**labels, 'status': status}, elapsed, LATENCY_BUCKETS)
+    metrics.observe('db_queries_per_request', labels, stats.queries, QUERY_BUCKETS)
+    metrics.inc('db_queries_total', labels, stats.queries)
+    metrics.inc('db_time_seconds_total', labels, stats.db_time)
+    metrics.inc('db_rows_total', labels, stats.rows)
+
+    for statement, count in stats.statements.items():
+        if count >= N_PLUS_ONE_THRESHOLD:
+            metrics.inc('db_n_plus_one_total', labels)
+            logger.warning("possible N+1 in %s %s: %d executions of %s",
+                           method, route, count, " ".join(statement.split())[:200])
+
+    if stats.samples is not None:
+        sampler.untrack()
+        if elapsed * 1000 >= PROFILE_SLOW_MS and stats.samples:
+            dump_profile(route, stats, elapsed)
+
+
+def init_app(app):
+    app.before_request(start_request)
+    app.after_request(finish_request)
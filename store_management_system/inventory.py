@@ -0,0 +1,173 @@
+import logging
+import time
+from datetime import datetime
+
+from sqlalchemy import select, update, bindparam, exists
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import SQLAlchemyError
+
+from database import Products, Orders, Replenishments, session, bump_owner_stats
+
+logger = logging.getLogger(__name__)
+
+
+def suggest_replenishments(db, owner_id=None, batch_size=1000):
+    # one pass over the products of every owner (or one), in primary key pages; a product whose on-hand stock
+    # minus its backorders is at or below its reorder point, and that has no open suggestion, gets one for its
+    # reorder quantity plus the backordered units. Returns the number of suggestions per owner
+    table = Replenishments.__table__
+    due = Products.prod_quantity - Products.backordered <= Products.reorder_point
+    already_open = exists().where(Replenishments.open_prod_id == Products.prod_id)
+
+    if db.get_bind().dialect.name == 'mysql':
+        statement = mysql_insert(table)
+        statement = statement.on_duplicate_key_update(open_prod_id=table.c.open_prod_id)
+    else:
+        statement = sqlite_insert(table).on_conflict_do_nothing(index_elements=[table.c.open_prod_id])
+
+    suggested = {}
+    last_id = 0
+    now = datetime.now()
+
+    while True:
+        query = (select(Products.owner_id, Products.prod_id, Products.prod_quantity, Products.backordered,
+                        Products.reorder_quantity)
+                 .where(Products.prod_id > last_id, due, ~already_open)
+                 .order_by(Products.prod_id)
+                 .limit(batch_size))
+        if owner_id is not None:
+            query = query.where(Products.owner_id == int(owner_id))
+
+        rows = db.execute(query).all()
+        if not rows:
+            return suggested
+
+        # the unique open_prod_id makes a concurrent run's duplicate a no-op
+        db.execute(statement, [{
+            'owner_id': row.owner_id,
+            'prod_id': row.prod_id,
+            'open_prod_id': row.prod_id,
+            'quantity': row.reorder_quantity + row.backordered,
+            'on_hand': row.prod_quantity,
+            'backordered': row.backordered,
+            'status': 'open',
+            'created_at': now,
+        } for row in rows])
+
+        for row in rows:
+            suggested[row.owner_id] = suggested.get(row.owner_id, 0) + 1
+        last_id = rows[-1].prod_id
+
+
+def run_scheduler(interval, owner_id=None, batch_size=1000, once=False):
+    # evaluates the reorder points in the background, outside any checkout transaction
+    while True:
+        started = time.perf_counter()
+        try:
+            suggested = suggest_replenishments(session, owner_id, batch_size)
+            session.commit()
+            logger.info("replenishment run took %.2fs, %d suggestion(s) for %d owner(s)",
+                        time.perf_counter() - started, sum(suggested.values()), len(suggested))
+        except SQLAlchemyError:
+            session.rollback()
+            logger.exception("replenishment run failed")
+            suggested = None
+        finally:
+            session.remove()
+
+        if once:
+            return suggested
+        time.sleep(max(interval - (time.perf_counter() - started), 0))
+
+
+def list_replenishments(owner_id):
+    rows = session.execute(select(Replenishments.id, Replenishments.prod_id, Products.prod_name,
+                                  Replenishments.quantity, Replenishments.created_at, Products.prod_quantity,
+                                  Products.backordered, Products.reorder_point)
+                           .join(Products, Products.prod_id == Replenishments.prod_id)
+                           .where(Replenishments.owner_id == int(owner_id), Replenishments.status == 'open')
+                           .order_by(Replenishments.id))
+    return [row._asdict() for row in rows]
+
+
+def receive_replenishment(owner_id, replenishment_id, quantity=None):
+    # books the delivery: backorders are filled first, oldest order lines first, and the rest goes on hand
+    try:
+        suggestion = session.scalar(select(Replenishments)
+                                    .where(Replenishments.id == replenishment_id,
+                                           Replenishments.owner_id == int(owner_id),
+                                           Replenishments.status == 'open')
+                                    .with_for_update())
+        if suggestion is None:
+            return None
+
+        units = suggestion.quantity if quantity is None else int(quantity)
+        product = session.scalar(select(Products).where(Products.prod_id == suggestion.prod_id).with_for_update())
+        filled = min(max(product.backordered, 0), units)
+
+        session.execute(update(Products)
+                        .where(Products.prod_id == product.prod_id)
+                        .values(prod_quantity=Products.prod_quantity + (units - filled),
+                                backordered=Products.backordered - filled))
+
+        lines = []
+        remaining = filled
+        for order_val, waiting in session.execute(select(Orders.order_val, Orders.backordered_quantity)
+                                                  .where(Orders.prod_id == product.prod_id,
+                                                         Orders.backordered_quantity > 0)
+                                                  .order_by(Orders.order_val)):
+            if remaining == 0:
+                break
+            delivered = min(waiting, remaining)
+            lines.append({'b_order_val': order_val, 'b_left': waiting - delivered})
+            remaining -= delivered
+
+        if lines:
+            orders_table = Orders.__table__
+            session.execute(update(orders_table)
+                            .where(orders_table.c.order_val == bindparam('b_order_val'))
+                            .values(backordered_quantity=bindparam('b_left')), lines)
+
+        bump_owner_stats(owner_id, touched=('products',))
+        suggestion.status = 'received'
+        suggestion.open_prod_id = None
+        suggestion.received_quantity = units
+        suggestion.resolved_at = datetime.now()
+        session.commit()
+        return {'received': units, 'backorders_filled': filled}
+    except SQLAlchemyError:
+        session.rollback()
+        print("\033[91mSQLAlchemyError: Could not receive replenishment\033[0m")
+        return False
+
+
+def dismiss_replenishment(owner_id, replenishment_id):
+    try:
+        dismissed = session.execute(update(Replenishments)
+                                    .where(Replenishments.id == replenishment_id,
+                                           Replenishments.owner_id == int(owner_id),
+                                           Replenishments.status == 'open')
+                                    .values(status='dismissed', open_prod_id=None,
+                                            resolved_at=datetime.now())).rowcount
+        session.commit()
+        return bool(dismissed)
+    except SQLAlchemyError:
+        session.rollback()
+        print("\033[91mSQLAlchemyError: Could not dismiss replenishment\033[0m")
+        return False
+
+
+def set_reorder_levels(owner_id, prod_id, reorder_point, reorder_quantity):
+    try:
+        updated = session.execute(update(Products)
+                                  .where(Products.prod_id == prod_id, Products.owner_id == int(owner_id))
+                                  .values(reorder_point=reorder_point, reorder_quantity=reorder_quantity)).rowcount
+        if updated:
+            bump_owner_stats(owner_id, touched=('products',))
+        session.commit()
+        return bool(updated)
+    except SQLAlchemyError:
+        session.rollback()
+        print("\033[91mSQLAlchemyError: Could not update reorder levels\033[0m")
+        return False
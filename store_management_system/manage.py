@@ -0,0 +1,10 @@
+from flask.cli import FlaskGroup
+
+from server import create_app
+
+# `flask --app` resolves server.py as part of the package and breaks its flat imports, so commands run from here
+cli = FlaskGroup(create_app=create_app)
+
+
+if __name__ == "__main__":
+    cli()
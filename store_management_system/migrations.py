@@ -0,0 +1,179 @@
+from datetime import datetime
+
+from sqlalchemy import (Table, MetaData, Column, Index, Integer, String, DateTime, inspect, select, text, update,
+                        bindparam)
+
+import database
+
+# bookkeeping lives outside Base so create_all never touches it
+schema_version = Table(
+    "schema_version", MetaData(),
+    Column("version", Integer, primary_key=True, autoincrement=False),
+    Column("description", String(200), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    def register(fn):
+        MIGRATIONS.append((version, description, fn))
+        return fn
+    return register
+
+
+def has_column(connection, table, column):
+    return column in {col['name'] for col in inspect(connection).get_columns(table)}
+
+
+def index(table_name, name, *columns, unique=False):
+    # an index as it stood at one schema version, on a table of its own rather than the model's: the models
+    # declare today's indexes, which can cover columns an older database only gets from a later migration
+    table = Table(table_name, MetaData(), *(Column(column, Integer) for column in columns))
+    return Index(name, *(table.c[column] for column in columns), unique=unique)
+
+
+def create_indexes(connection, indexes):
+    for entry in indexes:
+        entry.create(connection, checkfirst=True)
+
+
+OWNER_INDEXES = (
+    index('orders', 'ix_orders_owner_order', 'owner_id', 'order_id'),
+    index('orders', 'ix_orders_owner_prod', 'owner_id', 'prod_id'),
+    index('orders', 'ix_orders_owner_ordered_at', 'owner_id', 'ordered_at'),
+    index('products', 'ix_products_owner_prod', 'owner_id', 'prod_id'),
+    index('customers', 'ix_customers_owner_id', 'owner_id', 'customer_id'),
+    index('employee', 'ix_employee_owner_id', 'owner_id', 'id'),
+    index('outlets', 'ix_outlets_owner_id', 'owner_id', 'id'),
+)
+
+CUSTOMER_INDEXES = (
+    index('customers', 'uq_customers_owner_email', 'owner_id', 'email_key', unique=True),
+    index('customers', 'ix_customers_owner_name', 'owner_id', 'name_key'),
+    index('orders', 'ix_orders_owner_customer', 'owner_id', 'customer_id'),
+)
+
+REPLENISHMENT_INDEXES = (
+    index('orders', 'ix_orders_prod_backordered', 'prod_id', 'backordered_quantity'),
+)
+
+
+# every migration must be idempotent: a database created by create_all already has the latest schema
+# and only gets stamped with the versions
+
+@migration(1, "add orders.ordered_at")
+def add_order_timestamp(connection):
+    if not has_column(connection, 'orders', 'ordered_at'):
+        connection.execute(text("ALTER TABLE orders ADD COLUMN ordered_at DATETIME"))
+
+
+@migration(2, "widen orders.order_id to BIGINT for snowflake ids")
+def widen_order_id(connection):
+    # SQLite stores any integer in an INTEGER column, only MySQL needs the change
+    if connection.dialect.name == 'mysql':
+        connection.execute(text("ALTER TABLE orders MODIFY order_id BIGINT NOT NULL"))
+
+
+@migration(3, "owner-scoped composite indexes for the hot queries")
+def add_owner_indexes(connection):
+    create_indexes(connection, OWNER_INDEXES)
+
+
+@migration(4, "time-bucketed sales rollups")
+def add_sales_rollups(connection):
+    database.SalesRollup.__table__.create(connection, checkfirst=True)
+    database.rebuild_sales_rollups(connection)
+
+
+@migration(5, "one customer per normalized email, linked from the orders")
+def dedupe_customers(connection):
+    if not has_column(connection, 'customers', 'email_key'):
+        connection.execute(text("ALTER TABLE customers ADD COLUMN email_key VARCHAR(100)"))
+        connection.execute(text("ALTER TABLE customers ADD COLUMN name_key VARCHAR(100) NOT NULL DEFAULT ''"))
+        connection.execute(text("ALTER TABLE customers ADD COLUMN order_count INTEGER NOT NULL DEFAULT 0"))
+        # every existing row was inserted for one order, so the merge below sums them into the real count
+        connection.execute(text("UPDATE customers SET order_count = 1"))
+
+    if not has_column(connection, 'orders', 'customer_id'):
+        if connection.dialect.name == 'mysql':
+            connection.execute(text("ALTER TABLE orders ADD COLUMN customer_id INTEGER NULL, "
+                                    "ADD CONSTRAINT fk_orders_customer FOREIGN KEY (customer_id) "
+                                    "REFERENCES customers (customer_id)"))
+        else:
+            connection.execute(text("ALTER TABLE orders ADD COLUMN customer_id INTEGER "
+                                    "REFERENCES customers (customer_id)"))
+
+    # the duplicates have to go before the unique index can be built
+    removed = database.dedupe_customers(connection)
+    create_indexes(connection, CUSTOMER_INDEXES)
+
+    # the dashboard card counted one customer per order until now; a database from before owner_stats has no
+    # rows to fix, they are computed on first use
+    if removed and inspect(connection).has_table('owner_stats'):
+        stats = database.OwnerStats.__table__
+        counts = database.compute_owner_stats(db=connection)
+        connection.execute(update(stats)
+                           .where(stats.c.owner_id == bindparam('b_owner_id'))
+                           .values(count_customers=bindparam('b_count')),
+                           [{'b_owner_id': owner_id, 'b_count': counts[owner_id]['count_customers']}
+                            for owner_id in removed if owner_id in counts])
+
+
+@migration(6, "reorder levels, backorders and replenishment suggestions")
+def add_replenishment(connection):
+    product_columns = {
+        'reorder_point': f"INTEGER NOT NULL DEFAULT {database.DEFAULT_REORDER_POINT}",
+        'reorder_quantity': f"INTEGER NOT NULL DEFAULT {database.DEFAULT_REORDER_QUANTITY}",
+        'backordered': "INTEGER NOT NULL DEFAULT 0",
+    }
+    for column, definition in product_columns.items():
+        if not has_column(connection, 'products', column):
+            connection.execute(text(f"ALTER TABLE products ADD COLUMN {column} {definition}"))
+
+    if not has_column(connection, 'orders', 'backordered_quantity'):
+        connection.execute(text("ALTER TABLE orders ADD COLUMN backordered_quantity INTEGER NOT NULL DEFAULT 0"))
+
+    create_indexes(connection, REPLENISHMENT_INDEXES)
+    database.Replenishments.__table__.create(connection, checkfirst=True)
+
+
+@migration(7, "per-owner data versions for conditional GETs and fragment caching")
+def add_data_versions(connection):
+    # owner_stats came with the models rather than a migration, so a database only ever migrated may lack it
+    database.OwnerStats.__table__.create(connection, checkfirst=True)
+    for scope in database.VERSION_SCOPES:
+        if not has_column(connection, 'owner_stats', f'{scope}_version'):
+            connection.execute(text(f"ALTER TABLE owner_stats ADD COLUMN {scope}_version INTEGER NOT NULL DEFAULT 0"))
+
+    if not has_column(connection, 'owner_stats', 'modified_at'):
+        connection.execute(text("ALTER TABLE owner_stats ADD COLUMN modified_at DATETIME"))
+
+
+def current_version(connection):
+    schema_version.create(connection, checkfirst=True)
+    return connection.execute(select(schema_version.c.version)
+                              .order_by(schema_version.c.version.desc())
+                              .limit(1)).scalar() or 0
+
+
+def upgrade(engine, target=None):
+    applied = []
+
+    with engine.begin() as connection:
+        version = current_version(connection)
+
+    for number, description, fn in sorted(MIGRATIONS, key=lambda entry: entry[0]):
+        if number <= version or (target is not None and number > target):
+            continue
+
+        # one transaction per migration (MySQL commits DDL implicitly, so the stamp follows each step)
+        with engine.begin() as connection:
+            fn(connection)
+            connection.execute(schema_version.insert().values(version=number,
+                                                              description=description,
+                                                              applied_at=datetime.now()))
+        applied.append((number, description))
+
+    return applied
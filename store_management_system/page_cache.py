@@ -0,0 +1,76 @@
+import hashlib
+import os
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import current_app, g, make_response, request
+from markupsafe import Markup
+
+from cache import owner_cache
+from database import get_owner_versions, replica_reads
+
+
+def init_app(app, template_folder, manifest_path):
+    # a page also changes with the templates and, through the fingerprinted static names, the asset manifest;
+    # both go into every validator, so a deploy never answers 304 with an old page
+    digest = hashlib.sha256()
+    newest = 0
+
+    paths = sorted(os.path.join(directory, name) for directory, _, names in os.walk(template_folder) for name in names)
+    if os.path.exists(manifest_path):
+        paths.append(manifest_path)
+
+    for path in paths:
+        with open(path, 'rb') as source:
+            digest.update(os.path.basename(path).encode('utf-8'))
+            digest.update(source.read())
+        newest = max(newest, int(os.path.getmtime(path)))
+
+    app.config['RENDER_DIGEST'] = digest.hexdigest()[:12]
+    app.config['RENDERED_SINCE'] = datetime.fromtimestamp(newest, timezone.utc)
+
+
+def conditional(*scopes):
+    # validators from the owner's data versions: a matching If-None-Match (or, without one, If-Modified-Since)
+    # is answered with 304 after a single primary key read, before the view queries or renders anything. The
+    # versions and the page are read from the same replica, so a body is never older than its ETag
+    def decorator(view):
+        @wraps(view)
+        @replica_reads()
+        def wrapper(*args, **kwargs):
+            versions, modified_at = get_owner_versions(kwargs.get('id', kwargs.get('owner_id')))
+            g.owner_versions = versions
+
+            etag = '-'.join([current_app.config['RENDER_DIGEST']] + [str(versions[scope]) for scope in scopes])
+            last_modified = current_app.config['RENDERED_SINCE']
+            if modified_at is not None:
+                last_modified = max(last_modified, modified_at.astimezone(timezone.utc).replace(microsecond=0))
+
+            if request.if_none_match:
+                fresh = request.if_none_match.contains_weak(etag)
+            else:
+                fresh = request.if_modified_since is not None and last_modified <= request.if_modified_since
+
+            response = current_app.response_class(status=304) if fresh else make_response(view(*args, **kwargs))
+            if response.status_code in (200, 304):
+                response.set_etag(etag, weak=True)
+                response.last_modified = last_modified
+                # the pages are per owner: browsers may keep them, but must revalidate every time
+                response.cache_control.private = True
+                response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
+
+def cached_fragment(owner_id, name, scope, build):
+    # an expensive part of a page, built at most once per data version of `scope` (and per template digest);
+    # call from a view wrapped in conditional() for the same owner
+    version = f"{g.owner_versions[scope]}:{current_app.config['RENDER_DIGEST']}"
+    html = owner_cache.versioned(owner_id, f"fragment:{name}", version, build)
+    return Markup(html or '')
+
+
+def cached_data(owner_id, name, scope, build):
+    # the same, for a listing a view serialises itself
+    return owner_cache.versioned(owner_id, f"data:{name}", g.owner_versions[scope], build)
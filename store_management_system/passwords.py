@@ -0,0 +1,73 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import bcrypt
+
+
+class PasswordPoolBusy(Exception):
+    pass
+
+
+class PasswordPool:
+    # bcrypt releases the GIL, so a few threads hash in parallel while request threads stay free;
+    # at most workers + queue_size jobs are admitted, anything beyond that is refused immediately
+
+    def __init__(self, workers, queue_size, timeout):
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordPoolBusy()
+
+        try:
+            future = self._executor.submit(fn, *args)
+        except RuntimeError:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise PasswordPoolBusy()
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    # threads do not survive fork(), so each worker process builds its own pool
+    global _pool, _pool_pid
+
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                workers = int(os.getenv('PASSWORD_WORKERS', os.cpu_count() or 2))
+                _pool = PasswordPool(workers=workers,
+                                     queue_size=int(os.getenv('PASSWORD_QUEUE', workers * 4)),
+                                     timeout=float(os.getenv('PASSWORD_TIMEOUT', 10)))
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def work_factor():
+    return int(os.getenv('BCRYPT_ROUNDS', 12))
+
+
+def hash_password(password):
+    rounds = work_factor()
+    return get_pool().run(lambda: bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8'))
+
+
+def check_password(password, hashed):
+    return get_pool().run(bcrypt.checkpw, password.encode('utf-8'), hashed.encode('utf-8'))
+
+
+def needs_rehash(hashed):
+    # bcrypt hashes look like $2b$<cost>$<salt+hash>
+    return int(hashed.split('$')[2]) != work_factor()
@@ -0,0 +1,288 @@
+import bisect
+import heapq
+import math
+import os
+import re
+import threading
+import unicodedata
+from collections import Counter, OrderedDict
+
+from sqlalchemy import select, func
+from sqlalchemy.exc import SQLAlchemyError
+
+from database import Products, session, replica_reads
+
+MAX_OWNERS = int(os.getenv('SEARCH_MAX_OWNERS', 256))
+# ranked matches kept per index, so the next pages and a query typed again skip the ranking
+MAX_CACHED_QUERIES = 64
+
+# a query word of at least this many letters, and no digits, that starts fewer than FUZZY_BELOW products' words
+# also finds words within FUZZY_MIN_SIMILARITY of it (typos); sizes and numbers only match by prefix
+FUZZY_MIN_LENGTH = 4
+FUZZY_BELOW = 50
+FUZZY_MIN_SIMILARITY = 0.5
+
+# live rows are read in batches of ranked matches growing up to FETCH_BATCH; a page that the stock filter leaves
+# short stops after MAX_SCAN matches and hands out a cursor to continue from there
+FETCH_BATCH = 2000
+MAX_SCAN = 20000
+
+# low is the replenishment scheduler's notion of it
+STOCK_FILTERS = {
+    'any': None,
+    'in': Products.prod_quantity > 0,
+    'out': Products.prod_quantity <= 0,
+    'low': Products.prod_quantity - Products.backordered <= Products.reorder_point,
+}
+
+WORD = re.compile(r'\w+')
+
+
+def words(text):
+    # lowercase words with the accents folded, so "Café" is found by "cafe"
+    if text.isascii():
+        return WORD.findall(text.lower())
+    text = unicodedata.normalize('NFKD', text.casefold())
+    return WORD.findall(''.join(char for char in text if not unicodedata.combining(char)))
+
+
+def trigrams(word):
+    # padded at the front only: a query word is usually the beginning of a word still being typed
+    padded = '  ' + word
+    return {padded[i:i + 3] for i in range(len(word))}
+
+
+def prefix_end(prefix):
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class ProductIndex:
+    # product names of one owner: the products of every word, the sorted words for prefix ranges, the words of
+    # every trigram for typos, and the sorted names for whole-name prefixes and the order within a rank
+
+    def __init__(self):
+        self.names = {}
+        self.postings = {}
+        self.vocabulary = []
+        self.grams = {}
+        self.sorted_names = []
+        self.positions = None
+        self.order = None
+        self.last_id = 0
+        self.stale = False
+        self.queries = OrderedDict()
+        self.lock = threading.RLock()
+
+    def add(self, rows):
+        with self.lock:
+            added, new_words = [], []
+            for prod_id, prod_name in rows:
+                tokens = words(prod_name)
+                name = ' '.join(tokens)
+                self.names[prod_id] = name
+                added.append((name, prod_id))
+                self.last_id = max(self.last_id, prod_id)
+
+                for word in set(tokens):
+                    products = self.postings.get(word)
+                    if products is None:
+                        products = self.postings[word] = []
+                        new_words.append(word)
+                        for gram in trigrams(word):
+                            self.grams.setdefault(gram, []).append(word)
+                    products.append(prod_id)
+
+            if added:
+                self.sorted_names = list(heapq.merge(self.sorted_names, sorted(added)))
+                self.vocabulary = list(heapq.merge(self.vocabulary, sorted(new_words)))
+                self.positions = None
+                self.queries.clear()
+
+    def discard(self, prod_ids):
+        # deleted products; their words stay behind and the ids are skipped from then on. SQLite hands out the
+        # id of a deleted last row again, so losing the highest id has the index rebuilt on the next search
+        with self.lock:
+            for prod_id in prod_ids:
+                self.names.pop(prod_id, None)
+            self.queries.clear()
+            if self.last_id in prod_ids:
+                self.stale = True
+
+    def _prefixed(self, token):
+        start = bisect.bisect_left(self.vocabulary, token)
+        end = bisect.bisect_left(self.vocabulary, prefix_end(token), start)
+        found = set()
+        for word in self.vocabulary[start:end]:
+            found.update(self.postings[word])
+        return found
+
+    def _fuzzy(self, token):
+        # words sharing enough of the token's trigrams, compared on their first len(token) + 1 letters so that
+        # a half-typed word still matches; returns the best similarity per product
+        query = trigrams(token)
+        needed = math.ceil(FUZZY_MIN_SIMILARITY * len(query))
+        shared = Counter()
+        for gram in query:
+            shared.update(self.grams.get(gram, ()))
+
+        scores = {}
+        for word, count in shared.items():
+            if count < needed or word.startswith(token):
+                continue
+            head = trigrams(word[:len(token) + 1])
+            similarity = len(query & head) / max(len(query), len(head))
+            if similarity >= FUZZY_MIN_SIMILARITY:
+                for prod_id in self.postings[word]:
+                    scores[prod_id] = max(scores.get(prod_id, 0), similarity)
+        return scores
+
+    def rank(self, query):
+        # the matching ids, best first: names starting with the query (an equal name first), then names where
+        # every query word starts a word, both alphabetically, then names matched with typos by similarity
+        tokens = words(query)
+        if not tokens:
+            return []
+        key = ' '.join(tokens)
+
+        with self.lock:
+            ranked = self.queries.get(key)
+            if ranked is not None:
+                self.queries.move_to_end(key)
+                return ranked
+
+            if self.positions is None:
+                self.order = [prod_id for _, prod_id in self.sorted_names]
+                self.positions = {prod_id: position for position, prod_id in enumerate(self.order)}
+
+            prefixed, matched, similarity = None, None, Counter()
+            for token in dict.fromkeys(tokens):
+                found = self._prefixed(token)
+                fuzzy = {}
+                if len(found) < FUZZY_BELOW and len(token) >= FUZZY_MIN_LENGTH and token.isalpha():
+                    fuzzy = self._fuzzy(token)
+                similarity.update(fuzzy)
+                prefixed = found if prefixed is None else prefixed & found
+                found = found | fuzzy.keys()
+                matched = found if matched is None else matched & found
+
+            start = bisect.bisect_left(self.sorted_names, (key,))
+            end = bisect.bisect_left(self.sorted_names, (prefix_end(key),), start)
+            leading = [prod_id for _, prod_id in self.sorted_names[start:end] if prod_id in self.names]
+            # sorting the alphabetical positions is much cheaper than sorting by the names
+            words_only = [self.order[position] for position in
+                          sorted(map(self.positions.__getitem__, (prefixed - set(leading)) & self.names.keys()))]
+            typos = sorted((matched - prefixed) & self.names.keys(),
+                           key=lambda prod_id: (-similarity[prod_id], self.positions[prod_id]))
+
+            ranked = self.queries[key] = leading + words_only + typos
+            while len(self.queries) > MAX_CACHED_QUERIES:
+                self.queries.popitem(last=False)
+            return ranked
+
+
+_indexes = OrderedDict()
+_registry_lock = threading.Lock()
+
+
+def latest_product_id(db, owner_id):
+    return db.scalar(select(func.max(Products.prod_id)).where(Products.owner_id == int(owner_id))) or 0
+
+
+def product_index(owner_id, db=session):
+    # products are only inserted and deleted, never renamed, so as with the outlet index the owner's highest
+    # product id tells whether the index is current; deleted products are dropped when a search reads them.
+    # Returns the index and that highest id, which on a lagging replica can be below the index's
+    owner_id = int(owner_id)
+    latest = latest_product_id(db, owner_id)
+
+    with _registry_lock:
+        index = _indexes.get(owner_id)
+        if index is None or index.stale:
+            index = _indexes[owner_id] = ProductIndex()
+            while len(_indexes) > MAX_OWNERS:
+                _indexes.popitem(last=False)
+        else:
+            _indexes.move_to_end(owner_id)
+
+    if latest > index.last_id:
+        with index.lock:
+            if latest > index.last_id:
+                index.add(db.execute(select(Products.prod_id, Products.prod_name)
+                                     .where(Products.owner_id == owner_id, Products.prod_id > index.last_id)
+                                     .order_by(Products.prod_id)
+                                     .execution_options(yield_per=10000)))
+    return index, latest
+
+
+def rank_products(owner_id, query):
+    # the index and its ranked matches on a session of the calling thread, for the async API: the first build
+    # of a large index takes seconds and must not run on the event loop. The connection is given back after
+    try:
+        index, _ = product_index(owner_id)
+        return index, index.rank(query)
+    finally:
+        session.remove()
+
+
+def search_products_in(db, owner_id, query, stock='any', limit=20, cursor=0):
+    # one page of matches with their current price and stock: ranked in memory, then read by primary key in
+    # rank order until the page is full. Returns (products, next cursor, number of name matches)
+    index, latest = product_index(owner_id, db)
+    return read_ranked(db, owner_id, index, index.rank(query), latest, stock, limit, cursor)
+
+
+def read_ranked(db, owner_id, index, ranked, latest, stock='any', limit=20, cursor=0):
+    # `latest` is the owner's highest product id on `db`, which may be a replica behind the index
+    condition = STOCK_FILTERS[stock]
+    found = []
+    position, stop = cursor, min(len(ranked), cursor + MAX_SCAN)
+    size = 2 * limit
+
+    while position < stop:
+        batch = ranked[position:min(stop, position + size)]
+        query = (select(Products.prod_id, Products.prod_name, Products.prod_price, Products.prod_quantity,
+                        Products.prod_image, Products.reorder_point, Products.reorder_quantity, Products.backordered)
+                 .where(Products.owner_id == int(owner_id), Products.prod_id.in_(batch)))
+        if condition is not None:
+            query = query.where(condition)
+        rows = {row.prod_id: row for row in db.execute(query)}
+
+        if condition is None:
+            # without a filter every id comes back unless the product was deleted, or is newer than what a
+            # replica has caught up to
+            missing = [prod_id for prod_id in batch if prod_id not in rows and prod_id <= latest]
+            if missing:
+                index.discard(missing)
+
+        for prod_id in batch:
+            position += 1
+            row = rows.get(prod_id)
+            if row is None:
+                continue
+            if ' '.join(words(row.prod_name)) != index.names.get(prod_id):
+                # an id given out again after another process saw it deleted; rebuilt on the next search
+                index.stale = True
+                continue
+            found.append(row._asdict())
+            if len(found) == limit:
+                return found, position if position < len(ranked) else None, len(ranked)
+
+        # a filter that keeps few products gets larger batches
+        size = min(2 * size, FETCH_BATCH)
+
+    return found, position if position < len(ranked) else None, len(ranked)
+
+
+@replica_reads()
+def search_products(owner_id, query, stock='any', limit=20, cursor=0):
+    try:
+        return search_products_in(session, owner_id, query, stock, limit, cursor)
+    except SQLAlchemyError:
+        session.rollback()
+        print("\033[91mSQLAlchemyError: Could not search products\033[0m")
+        return None
+
+
+def clear_indexes():
+    with _registry_lock:
+        _indexes.clear()
@@ -1,48 +1,134 @@
+import argparse
+import logging
 import os
-from flask import Flask, render_template, request, redirect, url_for, jsonify, send_from_directory
+import time as timer
+import click
+from datetime import date, datetime, time, timedelta
+from flask import (Flask, Blueprint, Response, abort, current_app, render_template, request, redirect, url_for, jsonify,
+                   send_file, send_from_directory, stream_with_context)
 from database import (insert_owner_into_db, check_presence_in_db, verify_signin_with_db, retrieve_store_loc,
-                      add_store_loc, retrieve_employees_data, add_employee_in_db, remove_employee, retrieve_products,
-                      add_product_in_db, remove_product, get_items_in_stock, add_order_in_db, get_sales_report,
-                      get_card_data)
+                      add_store_loc, retrieve_employees_data, add_employee_in_db, remove_employee,
+                      retrieve_products_page, add_product_in_db, remove_product, get_items_in_stock, add_order_in_db,
+                      get_card_data, get_sales_report_page, rebuild_owner_stats, rebuild_sales_rollups, get_sales_trend,
+                      ROLLUP_GRANULARITIES, search_customers, session, get_engine, get_replica_engines, init_db,
+                      PRIMARY_COOKIE, PRIMARY_STICKY_SECONDS)
+from migrations import upgrade
+from cache import owner_cache
+from passwords import PasswordPoolBusy
+from importer import IMPORTS, iter_csv_rows, iter_json_rows, import_rows
+from exporter import EXPORTS, export_chunks
+from spatial import outlet_index, MAX_ZOOM
+from search import search_products, STOCK_FILTERS
+from inventory import (run_scheduler, list_replenishments, receive_replenishment, dismiss_replenishment,
+                       set_reorder_levels)
+import instrumentation
+import assets
+import images
+import page_cache
+from page_cache import conditional, cached_fragment, cached_data
 
 current_directory = os.path.dirname(os.path.abspath(__file__))
 
 static_folder_path = os.path.join(current_directory, 'static')
 template_folder_path = os.path.join(current_directory, 'templates')
+asset_build_path = os.path.join(current_directory, 'static_build')
 
-app = Flask(__name__, static_folder=static_folder_path, template_folder=template_folder_path)
+bp = Blueprint('store', __name__, cli_group=None)
 
 
-@app.route("/")
+def create_app():
+    app = Flask(__name__, static_folder=static_folder_path, template_folder=template_folder_path)
+    app.config['SALES_REPORT_PAGE_SIZE'] = int(os.getenv('SALES_REPORT_PAGE_SIZE', 25))
+    app.config['SALES_REPORT_MAX_PAGE_SIZE'] = int(os.getenv('SALES_REPORT_MAX_PAGE_SIZE', 200))
+    app.config['IMPORT_CHUNK_SIZE'] = int(os.getenv('IMPORT_CHUNK_SIZE', 1000))
+    app.config['IMPORT_MAX_CHUNK_SIZE'] = int(os.getenv('IMPORT_MAX_CHUNK_SIZE', 10000))
+    app.config['EXPORT_BATCH_SIZE'] = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+    app.config['SALES_TREND_MAX_POINTS'] = int(os.getenv('SALES_TREND_MAX_POINTS', 1000))
+    app.config['OUTLETS_MAX_MARKERS'] = int(os.getenv('OUTLETS_MAX_MARKERS', 2000))
+    app.config['OUTLETS_MAX_NEAREST'] = int(os.getenv('OUTLETS_MAX_NEAREST', 100))
+    app.config['CUSTOMER_SEARCH_LIMIT'] = int(os.getenv('CUSTOMER_SEARCH_LIMIT', 10))
+    app.config['PRODUCT_SEARCH_PAGE_SIZE'] = int(os.getenv('PRODUCT_SEARCH_PAGE_SIZE', 20))
+    app.config['PRODUCT_SEARCH_MAX_PAGE_SIZE'] = int(os.getenv('PRODUCT_SEARCH_MAX_PAGE_SIZE', 100))
+    app.config['ISSUE_ORDER_GRID_SIZE'] = int(os.getenv('ISSUE_ORDER_GRID_SIZE', 200))
+    app.config['ASSET_BUILD_DIR'] = os.getenv('ASSET_BUILD_DIR', asset_build_path)
+    app.config['IMAGE_MAX_AGE'] = int(os.getenv('IMAGE_MAX_AGE', 86400))
+
+    app.register_blueprint(bp)
+    app.before_request(read_own_writes)
+    app.after_request(remember_writes)
+    app.teardown_appcontext(remove_session)
+    assets.init_app(app)
+    page_cache.init_app(app, template_folder_path,
+                        os.path.join(app.config['ASSET_BUILD_DIR'], assets.MANIFEST_NAME))
+    if os.getenv('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes'):
+        instrumentation.init_app(app)
+
+    return app
+
+
+def read_own_writes():
+    # a client that wrote moments ago reads from the primary until the replicas have caught up
+    if PRIMARY_COOKIE in request.cookies:
+        session.info['primary'] = True
+
+
+def remember_writes(response):
+    if session.registry.has() and session.info.get('wrote') and get_replica_engines():
+        response.set_cookie(PRIMARY_COOKIE, '1', max_age=PRIMARY_STICKY_SECONDS, httponly=True, samesite='Lax')
+    return response
+
+
+def remove_session(exception=None):
+    # rolls back anything left open (e.g. after a failed commit) and returns the connection to the pool
+    session.remove()
+
+
+@bp.url_value_preprocessor
+def require_numeric_owner(endpoint, values):
+    # owner ids are integer keys; anything else is an unknown page rather than a failed query
+    owner_id = (values or {}).get('id', (values or {}).get('owner_id'))
+    if owner_id is not None and not str(owner_id).isdigit():
+        abort(404)
+
+
+@bp.errorhandler(PasswordPoolBusy)
+def password_pool_busy(error):
+    # sign-in/sign-up bursts are shed instead of queueing behind bcrypt and starving the other routes
+    return "<h1>Too many sign-ins right now, please try again in a moment</h1>", 503, {'Retry-After': '1'}
+
+
+@bp.route("/")
 def home():
     return render_template('home.html')
 
 
-@app.route("/signup")
+@bp.route("/signup")
 def sign_up():
     return render_template('signup.html')
 
 
-@app.route("/signin")
+@bp.route("/signin")
 def sign_in():
     return render_template('signin.html')
 
 
-@app.route("/verify_signin", methods=['POST'])
+@bp.route("/verify_signin", methods=['POST'])
 def verify_signin():
     data = request.form 
     result = verify_signin_with_db(data)
     if result is not None:
         user_id, user_name = result
-        return redirect(url_for('user_dashboard', id=user_id, name=user_name))
+        return redirect(url_for('.user_dashboard', id=user_id, name=user_name))
     else:
         return render_template('user_does_not_exist.html')
 
 
-@app.route("/<id>/<name>/dashboard")
+@bp.route("/<id>/<name>/dashboard")
+@conditional('products', 'sales')
 def user_dashboard(id, name):
-    x_values_graph1, y_values_graph1 = get_items_in_stock(id)
-    sales_table_values = get_sales_report(id)
+    # the listings behind a conditional page are read under its data version rather than from the per-process
+    # listing cache, so a body is never older than the ETag it is sent with
+    x_values_graph1, y_values_graph1 = cached_data(id, 'stock', 'products', lambda: get_items_in_stock.__wrapped__(id))
     card_datas = get_card_data(id)
 
     return render_template('dashboard.html',
@@ -54,11 +140,69 @@ def user_dashboard(id, name):
                                'x_values_g1': x_values_graph1,
                                'y_values_g1': y_values_graph1
                            },
-                           sales_report=sales_table_values,
                            card_data=card_datas)
 
 
-@app.route("/signup/successful", methods=['POST'])
+@bp.route("/<id>/<name>/sales_report")
+@conditional('sales')
+def sales_report(id, name):
+    args = request.args
+
+    try:
+        limit = int(args.get('limit', current_app.config['SALES_REPORT_PAGE_SIZE']))
+        before = int(args['cursor']) if args.get('cursor') else None
+        prod_id = int(args['product']) if args.get('product') else None
+        # dates are inclusive on both ends
+        start = datetime.combine(date.fromisoformat(args['start']), time.min) if args.get('start') else None
+        end = (datetime.combine(date.fromisoformat(args['end']) + timedelta(days=1), time.min)
+               if args.get('end') else None)
+    except ValueError:
+        return jsonify({"status": "failed", "message": "Invalid filter or cursor"}), 400
+
+    if not 1 <= limit <= current_app.config['SALES_REPORT_MAX_PAGE_SIZE']:
+        return jsonify({"status": "failed", "message": "Invalid page size"}), 400
+
+    orders, next_cursor = get_sales_report_page(id, limit, before=before, start=start, end=end, prod_id=prod_id)
+
+    # order ids are 64-bit and would lose precision as JavaScript numbers
+    for order in orders:
+        order['order_id'] = str(order['order_id'])
+
+    return jsonify({
+        "orders": orders,
+        "next_cursor": str(next_cursor) if next_cursor is not None else None
+    })
+
+
+@bp.route("/<id>/<name>/sales_trend")
+@conditional('sales')
+def sales_trend(id, name):
+    args = request.args
+    granularity = args.get('granularity', 'day')
+    periods = {'hour': timedelta(hours=1), 'day': timedelta(days=1), 'month': timedelta(days=31)}
+
+    try:
+        prod_id = int(args['product']) if args.get('product') else None
+        # dates are inclusive on both ends; by default the last 30 days
+        end = (datetime.combine(date.fromisoformat(args['end']) + timedelta(days=1), time.min)
+               if args.get('end') else datetime.combine(date.today() + timedelta(days=1), time.min))
+        start = (datetime.combine(date.fromisoformat(args['start']), time.min)
+                 if args.get('start') else end - timedelta(days=30))
+    except ValueError:
+        return jsonify({"status": "failed", "message": "Invalid filter"}), 400
+
+    if granularity not in ROLLUP_GRANULARITIES:
+        return jsonify({"status": "failed", "message": f"granularity must be one of {list(ROLLUP_GRANULARITIES)}"}), 400
+    if not start < end or (end - start) / periods[granularity] > current_app.config['SALES_TREND_MAX_POINTS']:
+        return jsonify({"status": "failed", "message": "Invalid range for this granularity"}), 400
+
+    return jsonify({
+        "granularity": granularity,
+        "series": get_sales_trend(id, granularity, start, end, prod_id)
+    })
+
+
+@bp.route("/signup/successful", methods=['POST'])
 def signup_successful():
     data = request.form
     is_present = check_presence_in_db(data)
@@ -72,41 +216,71 @@ def signup_successful():
                                signup_details=data)
 
 
-@app.route("/<id>/<name>/outlet")
+@bp.route("/<id>/<name>/outlet")
 def outlet(id, name):
 
     return render_template('outlet.html',
                            details={'owner_id': id, 'name': name})
 
 
-@app.route("/<id>/<name>/employee-data")
+@bp.route("/<id>/<name>/employee-data")
+@conditional('employees')
 def employee_data(id, name):
     err_message = request.args.get('message')
-    db = retrieve_employees_data(id)
+
+    def employee_rows():
+        employees = retrieve_employees_data.__wrapped__(id)
+        if employees is not None:
+            return render_template('employee_rows.html', emp_data=employees)
 
     return render_template('employee_data.html',
                            details={'owner_id': id, 'name': name},
-                           emp_data=db,
+                           employee_rows=cached_fragment(id, 'employee_rows', 'employees', employee_rows),
                            message=err_message)
 
 
-@app.route("/<id>/<name>/issue_order/<product_img>")
+@bp.route("/<id>/<name>/issue_order/<product_img>")
 def get_image(id, name, product_img):
     return send_from_directory('static/images/card_images', product_img)
 
 
-@app.route("/<id>/<name>/issue-order")
+@bp.route("/<id>/<name>/issue_order/<product_img>/<size>.<fmt>")
+def get_image_variant(id, name, product_img, size, fmt):
+    if images.source_path(product_img) is None or size not in images.SIZES or fmt not in images.FORMATS:
+        abort(404)
+
+    path = images.variant_path(product_img, size, fmt)
+    if path is None:
+        # not built yet (or older than its source): queue it and serve the original meanwhile, uncached
+        images.schedule_variants(product_img)
+        return get_image(id, name, product_img)
+
+    # send_file answers If-None-Match with 304 and Range with 206 from the file's ETag and size
+    return send_file(path, mimetype='image/webp' if fmt == 'webp' else 'image/jpeg',
+                     max_age=current_app.config['IMAGE_MAX_AGE'])
+
+
+@bp.route("/<id>/<name>/issue-order")
+@conditional('products')
 def products_data(id, name):
     err_message = request.args.get('message')
-    db = retrieve_products(id)
+    details = {'owner_id': id, 'name': name}
+
+    def product_grid():
+        # the card links carry the owner's name, so it is part of the fragment's key. Large catalogs only get
+        # their first cards here, the rest is found through the product search
+        products = retrieve_products_page(id, current_app.config['ISSUE_ORDER_GRID_SIZE'])
+        if products is not False:
+            return render_template('product_grid.html', details=details, product_data=products,
+                                   count_products=get_card_data(id)['count_products'])
 
     return render_template('issue_order.html',
-                           details={'owner_id': id, 'name': name},
-                           product_data=db,
+                           details=details,
+                           product_grid=cached_fragment(id, f"product_grid:{name}", 'products', product_grid),
                            message=err_message)
 
 
-@app.route("/<id>/<name>/place_order", methods=['POST'])
+@bp.route("/<id>/<name>/place_order", methods=['POST'])
 def place_order(id, name):
     data = request.json
     order_details = []
@@ -124,13 +298,54 @@ def place_order(id, name):
 
     if status == "done":
         return jsonify({"status": "success"})
-    elif status == "stock":
-        return jsonify({"status": "stock"})
+    elif status == "backordered":
+        return jsonify({"status": "backordered"})
     else:
         return jsonify({"status": "failed"})
 
 
-@app.route("/<id>/<name>/add-product", methods=['POST'])
+@bp.route("/<id>/<name>/customers/search")
+def customer_search(id, name):
+    # typeahead for the order form: customers whose email or name starts with q
+    limit = current_app.config['CUSTOMER_SEARCH_LIMIT']
+    customers = search_customers(id, request.args.get('q', ''), limit)
+
+    if customers is None:
+        return jsonify({"status": "failed", "message": "Could not search customers"}), 500
+    return jsonify({"customers": customers})
+
+
+@bp.route("/<id>/<name>/products/search")
+def product_search(id, name):
+    # paged typeahead over the product names: q matched by word prefixes and with typos, best matches first,
+    # optionally only the products in, out of or low on stock
+    args = request.args
+    stock = args.get('stock', 'any')
+
+    try:
+        limit = int(args.get('limit', current_app.config['PRODUCT_SEARCH_PAGE_SIZE']))
+        cursor = int(args.get('cursor') or 0)
+    except ValueError:
+        return jsonify({"status": "failed", "message": "Invalid page size or cursor"}), 400
+
+    if not 1 <= limit <= current_app.config['PRODUCT_SEARCH_MAX_PAGE_SIZE'] or cursor < 0:
+        return jsonify({"status": "failed", "message": "Invalid page size or cursor"}), 400
+    if stock not in STOCK_FILTERS:
+        return jsonify({"status": "failed", "message": f"stock must be one of {list(STOCK_FILTERS)}"}), 400
+
+    result = search_products(id, args.get('q', ''), stock, limit, cursor)
+    if result is None:
+        return jsonify({"status": "failed", "message": "Could not search products"}), 500
+
+    products, next_cursor, matches = result
+    return jsonify({
+        "products": products,
+        "matches": matches,
+        "next_cursor": str(next_cursor) if next_cursor is not None else None
+    })
+
+
+@bp.route("/<id>/<name>/add-product", methods=['POST'])
 def add_products(id, name):
     data = request.form
     prod_name = data.get('prod-name')
@@ -139,7 +354,7 @@ def add_products(id, name):
     prod_img = data.get('prod-img')
 
     if not prod_name or not prod_price or not prod_quantity or not prod_img:
-        return redirect(url_for('products_data',
+        return redirect(url_for('.products_data',
                                 id=id,
                                 name=name,
                                 message="None of the fields can be null"))
@@ -148,22 +363,67 @@ def add_products(id, name):
         status = add_product_in_db(id, prod_name, prod_price, prod_quantity, prod_img)
 
         if status:
-            return redirect(url_for('products_data',
+            return redirect(url_for('.products_data',
                                     id=id,
                                     name=name,
                                     message=None))
         else:
-            return redirect(url_for('products_data',
+            return redirect(url_for('.products_data',
                                     id=id,
                                     name=name,
                                     message="There was an error inserting new product details"))
 
 
-@app.route("/get_coordinates/<owner_id>")
-def get_coordinates(owner_id):
-    coords = retrieve_store_loc(owner_id)
+@bp.route("/<id>/<name>/products/<prod_id>/reorder", methods=['POST'])
+def reorder_levels(id, name, prod_id):
+    try:
+        reorder_point = int(request.form['reorder_point'])
+        reorder_quantity = int(request.form['reorder_quantity'])
+    except (KeyError, ValueError):
+        return jsonify({"status": "failed", "message": "Expected reorder_point and reorder_quantity"}), 400
+
+    if reorder_point < 0 or reorder_quantity <= 0:
+        return jsonify({"status": "failed", "message": "Reorder levels out of range"}), 400
+
+    if set_reorder_levels(id, prod_id, reorder_point, reorder_quantity):
+        return jsonify({"status": "success"})
+    return jsonify({"status": "failed"}), 404
+
+
+@bp.route("/<id>/<name>/replenishments")
+def replenishments(id, name):
+    return jsonify({"replenishments": list_replenishments(id)})
 
-    print(coords)
+
+@bp.route("/<id>/<name>/replenishments/<int:replenishment_id>/receive", methods=['POST'])
+def receive(id, name, replenishment_id):
+    try:
+        quantity = int(request.form['quantity']) if request.form.get('quantity') else None
+    except ValueError:
+        return jsonify({"status": "failed", "message": "Invalid quantity"}), 400
+
+    if quantity is not None and quantity <= 0:
+        return jsonify({"status": "failed", "message": "Invalid quantity"}), 400
+
+    received = receive_replenishment(id, replenishment_id, quantity)
+    if received is None:
+        return jsonify({"status": "failed", "message": "No such open replenishment"}), 404
+    if received is False:
+        return jsonify({"status": "failed"}), 500
+    return jsonify({"status": "success", **received})
+
+
+@bp.route("/<id>/<name>/replenishments/<int:replenishment_id>/dismiss", methods=['POST'])
+def dismiss(id, name, replenishment_id):
+    if dismiss_replenishment(id, replenishment_id):
+        return jsonify({"status": "success"})
+    return jsonify({"status": "failed"}), 404
+
+
+@bp.route("/get_coordinates/<owner_id>")
+@conditional('outlets')
+def get_coordinates(owner_id):
+    coords = cached_data(owner_id, 'store_loc', 'outlets', lambda: retrieve_store_loc.__wrapped__(owner_id))
 
     if coords is not None:
         return jsonify({
@@ -174,7 +434,54 @@ def get_coordinates(owner_id):
         return jsonify([])
 
 
-@app.route("/<id>/<name>/add_loc", methods=['POST'])
+@bp.route("/<id>/<name>/outlets/viewport")
+def outlets_in_viewport(id, name):
+    args = request.args
+
+    try:
+        south, west, north, east = (float(args[key]) for key in ('south', 'west', 'north', 'east'))
+        zoom = int(args.get('zoom', 0))
+        if not 0 <= zoom <= MAX_ZOOM:
+            raise ValueError(zoom)
+        # also rejects nan, which every comparison fails
+        if not all(-90 <= lat <= 90 for lat in (south, north)) or not all(-180 <= lng <= 180 for lng in (west, east)):
+            raise ValueError((south, west, north, east))
+    except (KeyError, ValueError):
+        return jsonify({"status": "failed",
+                        "message": f"Expected south, west, north, east in range and a zoom from 0 to {MAX_ZOOM}"}), 400
+
+    index = outlet_index(id)
+    clusters, singles = index.cluster(south, west, north, east, zoom)
+    max_markers = current_app.config['OUTLETS_MAX_MARKERS']
+
+    return jsonify({
+        "clusters": clusters,
+        "outlets": [{'id': outlet_id, 'lat': lat, 'lng': lng} for lat, lng, outlet_id in singles[:max_markers]],
+        "truncated": len(singles) > max_markers,
+        "extent": index.extent
+    })
+
+
+@bp.route("/<id>/<name>/outlets/nearest")
+def nearest_outlets(id, name):
+    args = request.args
+
+    try:
+        lat, lng = float(args['lat']), float(args['lng'])
+        k = int(args.get('k', 5))
+    except (KeyError, ValueError):
+        return jsonify({"status": "failed", "message": "Expected lat, lng and k"}), 400
+
+    if not -90 <= lat <= 90 or not -180 <= lng <= 180 or not 1 <= k <= current_app.config['OUTLETS_MAX_NEAREST']:
+        return jsonify({"status": "failed", "message": "Coordinates or k out of range"}), 400
+
+    return jsonify({
+        "outlets": [{'id': outlet_id, 'lat': outlet_lat, 'lng': outlet_lng, 'distance_km': round(distance, 3)}
+                    for distance, (outlet_lat, outlet_lng, outlet_id) in outlet_index(id).nearest(lat, lng, k)]
+    })
+
+
+@bp.route("/<id>/<name>/add_loc", methods=['POST'])
 def add_loc(id, name):
     data = request.form
 
@@ -197,7 +504,7 @@ def add_loc(id, name):
                                    message="There was an error inserting the store location")
 
 
-@app.route("/<id>/<name>/add_employee", methods=['POST'])
+@bp.route("/<id>/<name>/add_employee", methods=['POST'])
 def add_employee(id, name):
     data = request.form
 
@@ -206,7 +513,7 @@ def add_employee(id, name):
     salary = data.get('emp-salary')
 
     if not emp_name or not post or not salary:
-        return redirect(url_for('employee_data',
+        return redirect(url_for('.employee_data',
                                 id=id,
                                 name=name,
                                 message="Name/Post/Salary fields cannot be null"))
@@ -215,18 +522,18 @@ def add_employee(id, name):
         status = add_employee_in_db(id, emp_name, post, salary)
 
         if status:
-            return redirect(url_for('employee_data',
+            return redirect(url_for('.employee_data',
                                     id=id,
                                     name=name,
                                     message=None))
         else:
-            return redirect(url_for('employee_data',
+            return redirect(url_for('.employee_data',
                                     id=id,
                                     name=name,
                                     message="There was an error inserting new employee details"))
 
 
-@app.route("/<id>/<name>/delete_employee/<emp_id>", methods=['POST'])
+@bp.route("/<id>/<name>/delete_employee/<emp_id>", methods=['POST'])
 def delete_employee(id, name, emp_id):
     status = remove_employee(emp_id, id)
 
@@ -236,9 +543,8 @@ def delete_employee(id, name, emp_id):
         return jsonify({"status": "failure"})
 
 
-@app.route("/<id>/<name>/delete_product/<prod_id>", methods=['POST'])
+@bp.route("/<id>/<name>/delete_product/<prod_id>", methods=['POST'])
 def delete_product(id, name, prod_id):
-    print("Triggered delete_product")
     status = remove_product(prod_id, id)
 
     if status:
@@ -247,6 +553,180 @@ def delete_product(id, name, prod_id):
         return jsonify({"status": "failure"})
 
 
+@bp.route("/<id>/<name>/import/<kind>", methods=['POST'])
+def bulk_import(id, name, kind):
+    upload = request.files.get('file')
+    if kind not in IMPORTS:
+        return jsonify({"status": "failed", "message": f"Unknown import kind, expected one of {sorted(IMPORTS)}"}), 400
+    if upload is None:
+        return jsonify({"status": "failed", "message": "No file uploaded"}), 400
+
+    file_format = request.form.get('format') or os.path.splitext(upload.filename or '')[1].lstrip('.').lower()
+    readers = {'csv': iter_csv_rows, 'json': iter_json_rows, 'ndjson': iter_json_rows, 'jsonl': iter_json_rows}
+    if file_format not in readers:
+        return jsonify({"status": "failed", "message": "Unknown file format, expected csv, json or ndjson"}), 400
+
+    try:
+        chunk_size = int(request.form.get('chunk_size', current_app.config['IMPORT_CHUNK_SIZE']))
+    except ValueError:
+        chunk_size = 0
+    if not 1 <= chunk_size <= current_app.config['IMPORT_MAX_CHUNK_SIZE']:
+        return jsonify({"status": "failed", "message": "Invalid chunk size"}), 400
+
+    # werkzeug spools large uploads to a temporary file, and the readers consume it row by row
+    report = import_rows(id, kind, readers[file_format](upload.stream), chunk_size)
+    report['status'] = "success" if not report['failed'] else "partial" if report['inserted'] else "failed"
+    return jsonify(report)
+
+
+@bp.route("/<id>/<name>/export/<kind>")
+def export(id, name, kind):
+    file_format = request.args.get('format', 'csv')
+    compress = request.args.get('gzip') in ('1', 'true')
+
+    if kind not in EXPORTS:
+        return jsonify({"status": "failed", "message": f"Unknown export, expected one of {sorted(EXPORTS)}"}), 400
+    if file_format not in ('csv', 'ndjson'):
+        return jsonify({"status": "failed", "message": "Unknown file format, expected csv or ndjson"}), 400
+
+    filename = f"{kind}.{file_format}" + (".gz" if compress else "")
+    mimetype = ('application/gzip' if compress
+                else 'text/csv' if file_format == 'csv' else 'application/x-ndjson')
+    chunks = export_chunks(id, kind, file_format, compress=compress,
+                           batch_size=current_app.config['EXPORT_BATCH_SIZE'])
+
+    # the app context (and with it the session) stays open until the last chunk is sent
+    return Response(stream_with_context(chunks), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+@bp.route("/metrics")
+def metrics():
+    return Response(instrumentation.metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@bp.route("/cache/stats")
+def cache_stats():
+    return jsonify(owner_cache.stats())
+
+
+@bp.cli.command("rebuild-stats", help="Recompute the dashboard aggregates from the raw tables.")
+@click.option('--verify', is_flag=True, help="Only report owners whose dashboard aggregates drifted.")
+def rebuild_stats(verify):
+    drifted, missing = rebuild_owner_stats(verify_only=verify)
+
+    for owner_id, detail in drifted.items():
+        click.echo(f"owner {owner_id}: stored {detail['stored']}, expected {detail['expected']}")
+    if missing:
+        click.echo(f"{len(missing)} owner(s) without stored aggregates yet, counted from the raw tables")
+
+    if verify:
+        click.echo(f"{len(drifted)} owner(s) drifted")
+        if drifted:
+            raise SystemExit(1)
+    else:
+        click.echo(f"rebuilt aggregates for {len(drifted)} owner(s)")
+
+
+@bp.cli.command("rebuild-rollups", help="Recompute the time-bucketed sales rollups from the raw orders.")
+@click.option('--owner', 'owner_id', type=int, help="Only rebuild this owner's rollups.")
+def rebuild_rollups(owner_id):
+    owners = rebuild_sales_rollups(session, owner_id)
+    session.commit()
+    click.echo(f"rebuilt sales rollups for {owners} owner(s)")
+
+
+@bp.cli.command("replenish", help="Suggest replenishments for products at or below their reorder point.")
+@click.option('--owner', 'owner_id', type=int, help="Only evaluate this owner's products.")
+@click.option('--every', 'interval', type=float, help="Keep running, evaluating every this many seconds.")
+@click.option('--batch-size', type=int, default=1000, show_default=True, help="Products read per query.")
+def replenish(owner_id, interval, batch_size):
+    if interval is None:
+        suggested = run_scheduler(0, owner_id, batch_size, once=True)
+        if suggested is None:
+            raise SystemExit(1)
+        click.echo(f"{sum(suggested.values())} replenishment(s) suggested for {len(suggested)} owner(s)")
+    else:
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+        run_scheduler(interval, owner_id, batch_size)
+
+
+@bp.cli.command("build-assets", help="Fingerprint the static files and precompress them for long-lived caching.")
+def build_assets():
+    target = current_app.config['ASSET_BUILD_DIR']
+    manifest = assets.build(static_folder_path, target)
+
+    click.echo(f"{len(manifest['files'])} file(s) fingerprinted into {target}, "
+               f"{len(manifest['encodings'])} with precompressed copies"
+               f"{'' if assets.brotli else ' (gzip only, install brotli for .br copies)'}")
+
+
+@bp.cli.command("build-image-variants", help="Resize every product image to the card sizes, as WebP and JPEG.")
+def build_image_variants():
+    if not images.pillow_available():
+        click.echo("Pillow is not installed, the original images are served")
+        raise SystemExit(1)
+
+    names = sorted(os.listdir(images.SOURCE_DIR))
+    written = sum(images.generate_variants(name) for name in names)
+    click.echo(f"{written} variant(s) written for {len(names)} image(s) into {images.VARIANT_DIR}")
+
+
+@bp.cli.command("init-db", help="Create missing tables and apply pending schema migrations.")
+def init_db_command():
+    init_db()
+    applied = upgrade(get_engine())
+
+    click.echo(f"tables created, {len(applied)} migration(s) applied")
+
+
+@bp.cli.command("migrate", help="Apply pending schema migrations.")
+@click.option('--to', 'target', type=int, help="Stop at this schema version.")
+def migrate(target):
+    applied = upgrade(get_engine(), target)
+
+    for number, description in applied:
+        click.echo(f"applied {number}: {description}")
+    if not applied:
+        click.echo("schema is up to date")
+
+
+def bench_routes(app, owner_id, owner_name, requests):
+    # in-process smoke benchmark against whatever database is configured; it only issues GETs
+    client = app.test_client()
+    paths = ["/", "/signin", "/signup"]
+
+    if owner_id:
+        paths += [f"/{owner_id}/{owner_name}/dashboard",
+                  f"/{owner_id}/{owner_name}/sales_report",
+                  f"/{owner_id}/{owner_name}/issue-order",
+                  f"/{owner_id}/{owner_name}/employee-data",
+                  f"/{owner_id}/{owner_name}/outlet",
+                  f"/get_coordinates/{owner_id}"]
+
+    print(f"{'route':<45}{'req/s':>10}{'status':>8}")
+    for path in paths:
+        start = timer.perf_counter()
+        for _ in range(requests):
+            status = client.get(path).status_code
+        elapsed = timer.perf_counter() - start
+        print(f"{path:<45}{requests / elapsed:>10.1f}{status:>8}")
+
+
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    parser = argparse.ArgumentParser(description="Run the development server")
+    parser.add_argument('--bench', action='store_true', help="report requests/sec for the main routes and exit")
+    parser.add_argument('--owner-id', help="owner whose pages are included in --bench")
+    parser.add_argument('--owner-name', default='bench')
+    parser.add_argument('--requests', type=int, default=100, help="requests per route in --bench")
+    args = parser.parse_args()
+
+    app = create_app()
+
+    if args.bench:
+        bench_routes(app, args.owner_id, args.owner_name, args.requests)
+    else:
+        app.run(host='0.0.0.0', port=5000, debug=True)
 
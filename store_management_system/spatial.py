@@ -0,0 +1,216 @@
+import math
+import os
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import select, func
+
+from database import Outlets, session
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+# leaflet tiles are 256 px wide; a cluster covers roughly the area of its icon
+TILE_PIXELS = 256
+CLUSTER_PIXELS = 60
+# the deepest zoom leaflet's default tile layers serve
+MAX_ZOOM = 22
+CLUSTER_MAX_ZOOM = int(os.getenv('SPATIAL_CLUSTER_MAX_ZOOM', 16))
+
+# the grid is sized so that an occupied cell holds about this many outlets
+POINTS_PER_CELL = 16
+MAX_OWNERS = int(os.getenv('SPATIAL_MAX_OWNERS', 256))
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def cluster_degrees(zoom):
+    return 360.0 * CLUSTER_PIXELS / (TILE_PIXELS * 2 ** zoom)
+
+
+def split_box(south, west, north, east):
+    # a viewport crossing the antimeridian (west > east) is two boxes
+    south, north = max(south, -90.0), min(north, 90.0)
+    if east - west >= 360:
+        return [(south, -180.0, north, 180.0)]
+
+    west = (west + 180) % 360 - 180
+    east = (east + 180) % 360 - 180
+    if west <= east:
+        return [(south, west, north, east)]
+    return [(south, west, north, 180.0), (south, -180.0, north, east)]
+
+
+class Grid:
+    # buckets keyed by square cells of `size` degrees; only occupied cells are stored
+
+    def __init__(self, size):
+        self.size = size
+        self.cells = {}
+
+    def cell(self, lat, lng):
+        return math.floor(lat / self.size), math.floor(lng / self.size)
+
+    def cells_in(self, south, west, north, east):
+        (y0, x0), (y1, x1) = self.cell(south, west), self.cell(north, east)
+
+        if (y1 - y0 + 1) * (x1 - x0 + 1) > len(self.cells):
+            # a box wider than the data (e.g. the whole world): walking the occupied cells is cheaper
+            for (y, x), bucket in self.cells.items():
+                if y0 <= y <= y1 and x0 <= x <= x1:
+                    yield bucket
+        else:
+            for y in range(y0, y1 + 1):
+                for x in range(x0, x1 + 1):
+                    bucket = self.cells.get((y, x))
+                    if bucket is not None:
+                        yield bucket
+
+
+class OutletIndex:
+    # outlets of one owner: a point grid for box and nearest queries, plus one aggregate grid per zoom level
+
+    def __init__(self):
+        self.points = []
+        self.last_id = 0
+        self.grid = Grid(1.0)
+        self.sized_for = 0
+        self.clusters = {}
+        self.extent = None
+        self.lock = threading.RLock()
+
+    def add(self, rows):
+        with self.lock:
+            for outlet_id, lat, lng in rows:
+                point = (lat, lng, outlet_id)
+                self.points.append(point)
+                self.last_id = max(self.last_id, outlet_id)
+                self.grid.cells.setdefault(self.grid.cell(lat, lng), []).append(point)
+                for grid in self.clusters.values():
+                    self._aggregate(grid, point)
+
+                if self.extent is None:
+                    self.extent = [lat, lng, lat, lng]
+                else:
+                    self.extent = [min(self.extent[0], lat), min(self.extent[1], lng),
+                                   max(self.extent[2], lat), max(self.extent[3], lng)]
+
+            if len(self.points) > 4 * self.sized_for:
+                self._resize()
+
+    def _resize(self):
+        # cell size follows the density of the data, re-bucketed whenever the outlet count has grown 4x
+        south, west, north, east = self.extent
+        area = max(north - south, 0.01) * max(east - west, 0.01)
+        size = math.sqrt(area / max(len(self.points) / POINTS_PER_CELL, 1))
+        self.grid = Grid(min(max(size, 0.0005), 45.0))
+        for point in self.points:
+            self.grid.cells.setdefault(self.grid.cell(point[0], point[1]), []).append(point)
+        self.sized_for = len(self.points)
+
+    @staticmethod
+    def _aggregate(grid, point):
+        key = grid.cell(point[0], point[1])
+        bucket = grid.cells.get(key)
+        if bucket is None:
+            grid.cells[key] = [1, point[0], point[1], point]
+        else:
+            bucket[0] += 1
+            bucket[1] += point[0]
+            bucket[2] += point[1]
+
+    def _cluster_grid(self, zoom):
+        grid = self.clusters.get(zoom)
+        if grid is None:
+            # built on the first request for this zoom and kept up to date by add()
+            grid = Grid(cluster_degrees(zoom))
+            for point in self.points:
+                self._aggregate(grid, point)
+            self.clusters[zoom] = grid
+        return grid
+
+    def in_box(self, south, west, north, east, limit=None):
+        found = []
+        with self.lock:
+            for box_south, box_west, box_north, box_east in split_box(south, west, north, east):
+                for bucket in self.grid.cells_in(box_south, box_west, box_north, box_east):
+                    for point in bucket:
+                        if box_south <= point[0] <= box_north and box_west <= point[1] <= box_east:
+                            found.append(point)
+                            if limit is not None and len(found) > limit:
+                                return found
+        return found
+
+    def nearest(self, lat, lng, k):
+        # widens a spherical cap around the point until it holds k outlets
+        radius = self.grid.size * KM_PER_DEGREE
+
+        with self.lock:
+            while True:
+                angle = radius / EARTH_RADIUS_KM
+                dlat = math.degrees(angle)
+                if lat + dlat >= 90 or lat - dlat <= -90 or math.sin(angle) >= math.cos(math.radians(lat)):
+                    dlng = 180.0
+                else:
+                    dlng = math.degrees(math.asin(math.sin(angle) / math.cos(math.radians(lat))))
+
+                candidates = sorted((haversine_km(lat, lng, point[0], point[1]), point)
+                                    for point in self.in_box(lat - dlat, lng - dlng, lat + dlat, lng + dlng))
+                within = [candidate for candidate in candidates if candidate[0] <= radius]
+
+                if len(within) >= k or radius >= math.pi * EARTH_RADIUS_KM:
+                    return within[:k]
+                radius *= 2
+
+    def cluster(self, south, west, north, east, zoom):
+        if zoom >= CLUSTER_MAX_ZOOM:
+            return [], self.in_box(south, west, north, east)
+
+        clusters, singles = [], []
+        with self.lock:
+            grid = self._cluster_grid(zoom)
+            for box in split_box(south, west, north, east):
+                for count, sum_lat, sum_lng, first in grid.cells_in(*box):
+                    if count == 1:
+                        singles.append(first)
+                    else:
+                        clusters.append({'lat': sum_lat / count, 'lng': sum_lng / count, 'count': count})
+        return clusters, singles
+
+
+_indexes = OrderedDict()
+_registry_lock = threading.Lock()
+
+
+def outlet_index(owner_id):
+    # outlets are only ever inserted, so the owner's highest outlet id tells whether the index is current;
+    # this keeps the per-process indexes of all workers in step with one indexed lookup per request
+    owner_id = int(owner_id)
+    latest = session.scalar(select(func.max(Outlets.id)).where(Outlets.owner_id == owner_id)) or 0
+
+    with _registry_lock:
+        index = _indexes.get(owner_id)
+        if index is None:
+            index = _indexes[owner_id] = OutletIndex()
+            while len(_indexes) > MAX_OWNERS:
+                _indexes.popitem(last=False)
+        else:
+            _indexes.move_to_end(owner_id)
+
+    if latest > index.last_id:
+        with index.lock:
+            if latest > index.last_id:
+                index.add(session.execute(select(Outlets.id, Outlets.lat, Outlets.lng)
+                                          .where(Outlets.owner_id == owner_id, Outlets.id > index.last_id)
+                                          .order_by(Outlets.id)
+                                          .execution_options(yield_per=10000)))
+    return index
+
+
+def clear_indexes():
+    with _registry_lock:
+        _indexes.clear()
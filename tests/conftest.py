@@ -0,0 +1,29 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# the app modules import each other by their flat names and read DB_STRING on first use, so both are set up before
+# any test imports them; the tests run against a throwaway SQLite file
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'store_management_system'))
+os.environ['DB_STRING'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}"
+os.environ['METRICS_ENABLED'] = 'false'
+
+
+@pytest.fixture(scope='session')
+def engine():
+    from database import get_engine, init_db
+    from migrations import upgrade
+
+    init_db()
+    upgrade(get_engine())
+    return get_engine()
+
+
+@pytest.fixture
+def db(engine):
+    from database import session
+
+    yield session
+    session.remove()
@@ -0,0 +1,43 @@
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import benchmark
+from database import Products
+
+
+THREADS = 8
+CHECKOUTS_PER_THREAD = 6
+QUANTITY = 2
+
+
+@pytest.mark.parametrize('stock', [THREADS * CHECKOUTS_PER_THREAD * QUANTITY * 2, 10], ids=['in-stock', 'backordered'])
+def test_concurrent_checkouts_keep_stock_exact(db, stock):
+    owner_id = benchmark.seed(5, 0, 0)
+    prod_ids = [prod_id for prod_id, in db.query(Products.prod_id).order_by(Products.prod_id)]
+    db.query(Products).update({Products.prod_quantity: stock, Products.backordered: 0})
+    db.commit()
+
+    def checkouts(base_url, worker_index):
+        rng = random.Random(worker_index)
+        sold = dict.fromkeys(prod_ids, 0)
+        statuses = []
+        for _ in range(CHECKOUTS_PER_THREAD):
+            # every cart holds the first (hot) product plus a couple of random ones
+            cart = {prod_ids[0]: QUANTITY, **dict.fromkeys(rng.sample(prod_ids, 2), QUANTITY)}
+            statuses.append(benchmark.place_order(base_url, owner_id, {str(k): str(v) for k, v in cart.items()}))
+            for prod_id, quantity in cart.items():
+                sold[prod_id] += quantity
+        return sold, statuses
+
+    with benchmark.live_server() as base_url, ThreadPoolExecutor(max_workers=THREADS) as pool:
+        results = list(pool.map(lambda worker_index: checkouts(base_url, worker_index), range(THREADS)))
+
+    assert {status for _, statuses in results for status in statuses} <= {'success', 'backordered'}
+
+    db.expire_all()
+    for prod_id, on_hand, backordered in db.query(Products.prod_id, Products.prod_quantity, Products.backordered):
+        # every unit sold either left the shelf or is owed, and the shelf never goes negative
+        assert on_hand - backordered == stock - sum(sold[prod_id] for sold, _ in results)
+        assert on_hand >= 0 and not (on_hand and backordered)
@@ -0,0 +1,27 @@
+import gzip
+import json
+import zlib
+
+import exporter
+
+
+def rows(count):
+    for order_id in range(1, count + 1):
+        yield {'order_id': order_id, 'total_sales': order_id * 10}
+
+
+def test_ndjson_sends_the_first_row_on_its_own():
+    chunks = exporter.ndjson_chunks(['order_id', 'total_sales'], rows(exporter.ROWS_PER_CHUNK + 3))
+
+    assert next(chunks) == b'{"order_id": "1", "total_sales": 10}\n'
+    rest = list(chunks)
+    assert [chunk.count(b'\n') for chunk in rest] == [exporter.ROWS_PER_CHUNK, 2]
+
+
+def test_gzip_flushes_the_first_chunk():
+    chunks = exporter.gzip_chunks(exporter.ndjson_chunks(['order_id', 'total_sales'], rows(3)))
+
+    first = next(chunks)
+    assert zlib.decompressobj(zlib.MAX_WBITS | 16).decompress(first) == b'{"order_id": "1", "total_sales": 10}\n'
+    lines = gzip.decompress(first + b''.join(chunks)).splitlines()
+    assert [json.loads(line)['order_id'] for line in lines] == ['1', '2', '3']
@@ -0,0 +1,80 @@
+import io
+
+import benchmark
+from importer import import_rows, iter_csv_rows, iter_json_rows
+
+
+def csv_rows(content):
+    return iter_csv_rows(io.BytesIO(content.encode('utf-8')))
+
+
+def json_rows(content):
+    return iter_json_rows(io.BytesIO(content.encode('utf-8')))
+
+
+def test_non_finite_coordinates_fail_their_own_rows(db):
+    owner_id = benchmark.seed(0, 0, 0)
+    report = import_rows(owner_id, 'outlets', csv_rows("lat,lng\nnan,nan\n10,inf\n1,2\n"), 1000)
+
+    assert report['inserted'] == 1
+    assert [error['row'] for error in report['errors']] == [2, 3]
+    assert all('finite' in error['error'] for error in report['errors'])
+
+
+def test_integers_beyond_the_column_fail_their_own_rows(db):
+    owner_id = benchmark.seed(0, 0, 0)
+    rows = csv_rows("prod_name,prod_price,prod_quantity,prod_image\n"
+                    "huge,100000000000000000000000000,1,a.jpg\n"
+                    "fine,10,1,a.jpg\n")
+    report = import_rows(owner_id, 'products', rows, 1000)
+
+    assert report['inserted'] == 1
+    assert report['errors'] == [{'row': 2, 'error': f"prod_price: must be at most {2 ** 31 - 1}"}]
+
+
+def test_json_numbers_out_of_range_fail_their_own_rows(db):
+    owner_id = benchmark.seed(0, 0, 0)
+    report = import_rows(owner_id, 'outlets', json_rows('[{"lat": NaN, "lng": 1}, {"lat": 1e400, "lng": 1}, '
+                                                       '{"lat": 1, "lng": 2}]'), 1000)
+
+    assert report['inserted'] == 1 and report['failed'] == 2
+
+
+class CountingStream(io.BytesIO):
+    def __init__(self, content):
+        super().__init__(content)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def read1(self, size=-1):
+        data = super().read1(size)
+        self.bytes_read += len(data)
+        return data
+
+    def readinto(self, buffer):
+        count = super().readinto(buffer)
+        self.bytes_read += count
+        return count
+
+
+def test_malformed_json_stops_at_the_broken_element(db):
+    owner_id = benchmark.seed(0, 0, 0)
+    good = '{"lat": 1, "lng": 2}, '
+    stream = CountingStream(('[' + good * 2 + '{"lat": 1, "lng": oops}, ' + good * 200000 + ']').encode('utf-8'))
+    report = import_rows(owner_id, 'outlets', iter_json_rows(stream), 1000)
+
+    assert report['inserted'] == 2
+    assert report['errors'][-1]['error'].startswith('could not parse file')
+    assert stream.bytes_read < 1024 * 1024
+
+
+def test_json_elements_split_across_reads_still_parse(db):
+    owner_id = benchmark.seed(0, 0, 0)
+    content = '\n'.join('{"lat": %d.123456789, "lng": "%s"}' % (i % 90, i % 180) for i in range(20000))
+    report = import_rows(owner_id, 'outlets', json_rows(content), 5000)
+
+    assert report['inserted'] == 20000 and report['failed'] == 0
@@ -0,0 +1,40 @@
+import pytest
+from sqlalchemy import text
+
+import benchmark
+from database import session
+
+
+# the owner-scoped queries and the index SQLite is expected to serve each of them from
+OWNER_INDEXES = {
+    'sales report lines': 'ix_orders_owner_order',
+    'sales report page': 'ix_orders_owner_order',
+    'sales report page, cursor': 'ix_orders_owner_order',
+    'sales report page, product': 'ix_orders_owner_prod',
+    'products of owner': 'ix_products_owner_prod',
+    'customers of owner': 'ix_customers_owner_id',
+    'employees of owner': 'ix_employee_owner_id',
+    'outlets of owner': 'ix_outlets_owner_id',
+    'customer search, email': 'uq_customers_owner_email',
+    'customer search, name': 'ix_customers_owner_name',
+}
+
+
+@pytest.fixture(scope='module')
+def hot_queries(engine):
+    # several owners, so a query that ignores the owner index has to scan the other owners' rows too
+    owner_id = benchmark.seed(50, 40, 3, n_owners=3)
+    session.execute(text("ANALYZE"))
+    yield benchmark.hot_queries(owner_id)
+    session.remove()
+
+
+@pytest.mark.parametrize('name', list(OWNER_INDEXES))
+def test_owner_query_uses_its_index(hot_queries, name):
+    plan, _ = benchmark.explain(hot_queries[name])
+    assert any(f" INDEX {OWNER_INDEXES[name]} " in line for line in plan), plan
+
+
+def test_hot_queries_avoid_full_scans(hot_queries):
+    plans = {name: benchmark.explain(statement) for name, statement in hot_queries.items()}
+    assert not {name: plan for name, (plan, full_scan) in plans.items() if full_scan}
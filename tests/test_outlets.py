@@ -0,0 +1,29 @@
+import pytest
+
+import benchmark
+from server import create_app
+
+
+VIEWPORT = {'south': '-10', 'west': '-10', 'north': '10', 'east': '10', 'zoom': '5'}
+
+
+@pytest.fixture(scope='module')
+def client(engine):
+    owner_id = benchmark.seed(0, 0, 0)
+    yield create_app().test_client(), owner_id
+
+
+@pytest.mark.parametrize('bad', [{'south': 'nan'}, {'north': 'inf'}, {'west': '-inf'}, {'east': '181'},
+                                 {'south': '-91'}, {'zoom': '-2000'}, {'zoom': '23'}, {'zoom': 'x'}])
+def test_viewport_rejects_bounds_out_of_range(client, bad):
+    test_client, owner_id = client
+    response = test_client.get(f"/{owner_id}/bench/outlets/viewport", query_string={**VIEWPORT, **bad})
+    assert response.status_code == 400
+    assert response.get_json()['status'] == 'failed'
+
+
+def test_viewport_accepts_a_box_across_the_antimeridian(client):
+    test_client, owner_id = client
+    response = test_client.get(f"/{owner_id}/bench/outlets/viewport",
+                               query_string={**VIEWPORT, 'west': '170', 'east': '-170'})
+    assert response.status_code == 200
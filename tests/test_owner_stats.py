@@ -0,0 +1,27 @@
+import benchmark
+from database import OwnerStats, bump_owner_stats, rebuild_owner_stats
+
+
+def test_verify_reports_owners_without_a_row_as_missing_not_drifted(db):
+    owner_id = benchmark.seed(5, 3, 2, n_owners=2)
+
+    drifted, missing = rebuild_owner_stats(verify_only=True)
+
+    assert drifted == {}
+    assert owner_id in missing and len(missing) == 2
+    assert db.get(OwnerStats, owner_id) is None
+
+
+def test_verify_reports_and_rebuild_fixes_a_drifted_row(db):
+    owner_id = benchmark.seed(5, 3, 2)
+    bump_owner_stats(owner_id)
+    db.commit()
+    bump_owner_stats(owner_id, products=7)
+    db.commit()
+
+    drifted, missing = rebuild_owner_stats(verify_only=True)
+    assert list(drifted) == [owner_id] and missing == []
+    assert drifted[owner_id]['stored']['count_products'] == drifted[owner_id]['expected']['count_products'] + 7
+
+    rebuild_owner_stats()
+    assert rebuild_owner_stats(verify_only=True) == ({}, [])
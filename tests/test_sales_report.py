@@ -0,0 +1,33 @@
+import benchmark
+from database import get_sales_report, get_sales_report_page
+
+
+def queries_for(report, orders, lines_per_order):
+    owner_id = benchmark.seed(20, orders, lines_per_order)
+    with benchmark.count_queries() as counter:
+        rows = report(owner_id)
+    return counter['queries'], rows
+
+
+def test_sales_report_query_count_is_constant(db):
+    few, rows = queries_for(get_sales_report, 2, 1)
+    many, more_rows = queries_for(get_sales_report, 60, 4)
+
+    assert len(rows) == 2 and len(more_rows) == 60
+    assert few == many
+
+
+def test_sales_report_page_query_count_is_constant(db):
+    few, (rows, _) = queries_for(lambda owner_id: get_sales_report_page(owner_id, 25), 2, 1)
+    many, (more_rows, next_cursor) = queries_for(lambda owner_id: get_sales_report_page(owner_id, 25), 60, 4)
+
+    assert len(rows) == 2 and len(more_rows) == 25 and next_cursor is not None
+    assert few == many
+
+
+def test_sales_report_matches_the_per_order_queries(db):
+    owner_id = benchmark.seed(20, 15, 3)
+
+    # the legacy loop ignores sold_prod_quantity, so only the order lines are comparable
+    assert sorted((row['order_id'], row['product_list']) for row in benchmark.legacy_sales_report(owner_id)) == \
+        [(row['order_id'], row['product_list']) for row in get_sales_report(owner_id)]